@@ -1,11 +1,12 @@
 from pgn_to_moves import pgn_to_games
 import argparse
-from compute_features import get_stockfish_features, get_material_difference
+from batch_features import game_bitboards, material_difference
 import csv
 import sys
+import numpy as np
 from eval_moves import Evaluator
 
-ev = Evaluator()
+ev = Evaluator(engine_cnt=1)
 
 def readCL():
     parser = argparse.ArgumentParser()
@@ -16,23 +17,25 @@ def readCL():
     return args
 
 def get_game_info(game, verbose):
-    sac_score = 0
-    for move in game.moves():
-        #sacs are scored as follows:
-        #a player scores points when the opponent has a turn with more material than you
-        #scored in proportion to material deficit squared
-        #of course, you must win in the end to earn the points
-        material_difference = (get_material_difference(move["fen"]))
-        #print(material_difference)
-        if move["turn"] != game.result(): #loser to move
-            if (material_difference > 0):
-                sac_score += material_difference ** 2
+    #sacs are scored as follows:
+    #a player scores points when the opponent has a turn with more material than you
+    #scored in proportion to material deficit squared
+    #of course, you must win in the end to earn the points
+    bitboards, turns = game_bitboards(game.game)
+    material_differences = material_difference(bitboards, turns)
+    loser_to_move = turns != game.result()
+    sac_score = int(np.sum(material_differences[loser_to_move & (material_differences > 0)] ** 2))
 
-        if verbose:
-            print(material_difference)
+    if verbose:
+        for diff in material_differences:
+            print(diff)
 
-    m, final_eval = ev.evaluate_cp(move["fen"],1000) #from perspective of the player to play
-    final_eval *= move["turn"] #from white's perspective
+    #position before the final move
+    board = game.game.board()
+    for move in list(game.game.mainline_moves())[:-1]:
+        board.push(move)
+    m, final_eval = ev.evaluate_cp(board.fen(),1000) #from perspective of the player to play
+    final_eval *= int(turns[-1]) #from white's perspective
 
     info = {
         "event": game.headers()["Event"],
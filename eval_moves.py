@@ -2,11 +2,16 @@ import chess
 import chess.uci
 import chess.polyglot
 import chess.engine
-import pickle
 import csv
 import math
+import os
 import os.path
 import random
+import queue
+import threading
+import concurrent.futures
+import asyncio
+from eval_store import EvalStore
 
 #Given an input of a number of games, sum across all positions
 #which positions had the most "loss" (ie players lost the most EV
@@ -14,18 +19,35 @@ import random
 
 STOCKFISH_BINARY = "/home/jtrigg/install/Stockfish/src/stockfish"
 INPUT_FILE = "/tmp/filtered_moves.csv"
-EVAL_FILE = "/home/jtrigg/files/misc/evals.pkl"
+EVAL_FILE = "/home/jtrigg/files/misc/evals.bin" #see eval_store.py to migrate an old evals.pkl
+ENGINE_CNT = os.cpu_count() or 1 #default size of the engine pool
 
 def sigmoid(x):
   return 1 / (1 + math.exp(-x))
 
 class Evaluator:
-  def __init__(self, eval_file=None):
+  def __init__(self, eval_file=None, engine_cnt=None):
+    #engine_cnt: number of stockfish processes to run evaluations across
+    #(None uses ENGINE_CNT, one per core). Single-position calls borrow any free engine
+    #and evaluate_many() fans a batch out across all of them
+    #the engines are started by the first search, so an Evaluator that only
+    #answers from the stored evals never starts any
     super()
+    self.init_evaluator(eval_file, engine_cnt)
+    self.engines_lock = threading.Lock()
+  def init_evaluator(self, eval_file, engine_cnt):
+    #setup shared with AsyncEvaluator: the eval store and the engine pool size
+    if engine_cnt is not None and engine_cnt < 1:
+      raise ValueError(f"engine_cnt must be at least 1, got {engine_cnt}")
     self.eval_file = eval_file if eval_file else EVAL_FILE
     self.load_evals()
-    self.engine = chess.uci.popen_engine(STOCKFISH_BINARY)
-    self.engine.uci()
+    self.engine_cnt = ENGINE_CNT if engine_cnt is None else engine_cnt
+    #guards self.evals, which is shared by the threads driving the engines
+    self.evals_lock = threading.RLock()
+    self.engines = None
+  def start_engine(self):
+    engine = chess.uci.popen_engine(STOCKFISH_BINARY)
+    engine.uci()
     #TODO: may want to rerun with Dynamic Contempt off
     #there's an interpretation that Dynamic Contempt is a measure of tempo
     #ie how valuable is it to have the move right now, in which case it should
@@ -36,66 +58,122 @@ class Evaluator:
     #better in this regard, so leaving it on for now
 
     #Uncomment this to  turn off dynamic contempt
-    # self.engine.setoption({"Contempt":0, "Dynamic Contempt": "Off"})
+    # engine.setoption({"Contempt":0, "Dynamic Contempt": "Off"})
 
     #Set contempt to 0
-    self.engine.setoption({"Contempt":0})
-
-    self.info_handler = chess.uci.InfoHandler()
-    self.engine.info_handlers.append(self.info_handler)
+    engine.setoption({"Contempt":0})
+
+    info_handler = chess.uci.InfoHandler()
+    engine.info_handlers.append(info_handler)
+    return engine, info_handler
+  def acquire_engine(self):
+    #blocks until one of the pooled engines is free
+    #return it with release_engine when done
+    with self.engines_lock:
+      if self.engines is None:
+        self.engines = queue.Queue()
+        for i in range(self.engine_cnt):
+          self.engines.put(self.start_engine())
+    return self.engines.get()
+  def release_engine(self, engine_info):
+    self.engines.put(engine_info)
   def evaluate_depth(self, fen, depth):
     #won't be saved
     board = chess.Board(fen)
-    self.engine.position(board)
-    engine_output = self.engine.go(depth=depth) # Gets a tuple of bestmove and ponder move
-    score = self.info_handler.info["score"][1]
+    engine, info_handler = self.acquire_engine()
+    try:
+      engine.position(board)
+      engine_output = engine.go(depth=depth) # Gets a tuple of bestmove and ponder move
+      score = info_handler.info["score"][1]
+    finally:
+      self.release_engine((engine, info_handler))
     return str(engine_output.bestmove), self.eval_to_centipawns(score.cp, score.mate)
+  def evaluate_moves_cp(self, fen, moves, time=100):
+    #{move: eval of playing move in fen} from the perspective of the side to play
+    #one MultiPV search of fen with the root restricted to moves (uci searchmoves),
+    #so the evals come from the same search and are comparable. won't be saved
+    board = chess.Board(fen)
+    engine, info_handler = self.acquire_engine()
+    try:
+      engine.setoption({"MultiPV": len(moves)})
+      engine.position(board)
+      engine.go(movetime=time, searchmoves=[chess.Move.from_uci(move) for move in moves])
+      evals = {}
+      for i, pv in info_handler.info["pv"].items():
+        score = info_handler.info["score"][i]
+        evals[pv[0].uci()] = self.eval_to_centipawns(score.cp, score.mate)
+    finally:
+      engine.setoption({"MultiPV": 1})
+      self.release_engine((engine, info_handler))
+    return evals
   def evaluate_cp(self, fen, time=100, max_centipawns=10*100): #100 millis default time
     move, (cp,mate) = self.memo_eval(fen, time)
     return move, self.eval_to_centipawns(cp, mate)
   def evaluate_ev(self, fen, time=100):
     move, (cp, mate) = self.memo_eval(fen, time)
     return move, self.eval_to_ev(cp, mate)
+  def evaluate_many(self, fens, time=100):
+    #evaluate a batch of positions across the engine pool
+    #results are (move, (cp, mate)) in the same order as fens
+    #and go through the same memo_eval cache as single evaluations
+    unique_fens = list(dict.fromkeys(fens)) #don't search duplicates twice
+    with concurrent.futures.ThreadPoolExecutor(max_workers=self.engine_cnt) as executor:
+      results = dict(zip(unique_fens, executor.map(lambda fen: self.memo_eval(fen, time), unique_fens)))
+    return [results[fen] for fen in fens]
+  def evaluate_many_cp(self, fens, time=100):
+    return [(move, self.eval_to_centipawns(cp, mate)) for move, (cp, mate) in self.evaluate_many(fens, time)]
+  def evaluate_many_ev(self, fens, time=100):
+    return [(move, self.eval_to_ev(cp, mate)) for move, (cp, mate) in self.evaluate_many(fens, time)]
   def get_eval_time(self, fen):
     #get the amount of time that this position has been evaluated
     board = chess.Board(fen)
     zobrist_hash = chess.polyglot.zobrist_hash(board)
-    eval_info = self.evals[zobrist_hash]
-    return eval_info["eval_time"]
+    with self.evals_lock:
+      eval_info = self.evals[zobrist_hash]
+      return eval_info["eval_time"]
   def memo_eval(self, fen, time=100):
     board = chess.Board(fen)
     zobrist_hash = chess.polyglot.zobrist_hash(board)
 
-    #update
-    if not zobrist_hash in self.evals:
-      if random.random() < 0.0001: #save once every 10k new evaluations
-        self.save_evals()
-      self.evals[zobrist_hash] = {"zobrist": zobrist_hash, "eval_time":0}
-
-    eval_info = self.evals[zobrist_hash]
-
-    if eval_info["eval_time"] == 0 and time <= 0:
-      raise
-    elif eval_info["eval_time"] == 0:
-      new_time = time
-      move, evaluation = self.run_eval(fen, new_time)
-      eval_info["eval_time"] = new_time
-      eval_info["eval"] = evaluation
-      eval_info["move"] = move
-    elif time > eval_info["eval_time"]:
-      #round input time to a power of 2 times eval_info["eval_time"]
-      new_time = eval_info["eval_time"] * 2 ** math.ceil(math.log(time/eval_info["eval_time"]) / math.log(2))
-      move, evaluation = self.run_eval(fen, new_time)
-      eval_info["eval_time"] = new_time
-      eval_info["eval"] = evaluation
-      eval_info["move"] = move
-    return eval_info["move"], eval_info["eval"]
+    new_time, cached = self.get_new_eval_time(zobrist_hash, time)
+    if new_time is None:
+      return cached
+
+    #search without holding the lock so the other engines can keep working
+    move, evaluation = self.run_eval(fen, new_time)
+    return self.record_eval(zobrist_hash, new_time, move, evaluation)
+  def get_new_eval_time(self, zobrist_hash, time):
+    #returns (time to search for, None) if the position needs a new search
+    #and (None, (move, eval)) if the cached evaluation is good enough
+    with self.evals_lock:
+      eval_info = self.evals.get(zobrist_hash)
+
+      if eval_info is None and time <= 0:
+        raise
+      elif eval_info is None:
+        return time, None
+      elif time > eval_info["eval_time"]:
+        #round input time to a power of 2 times eval_info["eval_time"]
+        return eval_info["eval_time"] * 2 ** math.ceil(math.log(time/eval_info["eval_time"]) / math.log(2)), None
+      else:
+        return None, (eval_info["move"], eval_info["eval"])
+  def record_eval(self, zobrist_hash, new_time, move, evaluation):
+    with self.evals_lock:
+      eval_info = self.evals.get(zobrist_hash)
+      if eval_info is None or new_time >= eval_info["eval_time"]: #another search may have finished a longer one
+        eval_info = {"zobrist": zobrist_hash, "eval_time": new_time, "eval": evaluation, "move": move}
+        self.evals.put(eval_info)
+      return eval_info["move"], eval_info["eval"]
   def run_eval(self, fen, time): #time in millis
     #returns ev in terms of the side to play
     board = chess.Board(fen)
-    self.engine.position(board)
-    engine_output = self.engine.go(movetime=time)  # Gets a tuple of bestmove and ponder move
-    score = self.info_handler.info["score"][1]
+    engine, info_handler = self.acquire_engine()
+    try:
+      engine.position(board)
+      engine_output = engine.go(movetime=time)  # Gets a tuple of bestmove and ponder move
+      score = info_handler.info["score"][1]
+    finally:
+      self.release_engine((engine, info_handler))
     return str(engine_output.bestmove), (score.cp, score.mate)
   def eval_to_centipawns(self, centipawns, mate):
     CAP_VAL = 10 * 100 #10+ pawns: huge advantage
@@ -123,14 +201,122 @@ class Evaluator:
     elif mate < 0: #you're getting mated
       return 0.1
   def load_evals(self):
-    #self.evals: zobrist -> {zobrist, eval_time, eval}
-    if (os.path.isfile(self.eval_file)):
-      self.evals = pickle.load(open(self.eval_file, "rb" ))
-    else:
-      self.evals = {}
+    #self.evals: zobrist -> {zobrist, eval_time, eval, move}
+    #records are appended to the store as they're computed, see eval_store.py
+    self.evals = EvalStore(self.eval_file)
   def save_evals(self):
-    #print(self.evals)
-    pickle.dump(self.evals, open(self.eval_file, "wb" ))
+    with self.evals_lock:
+      self.evals.flush()
+  def refresh_evals(self):
+    #pick up evaluations other processes have appended to the store since it was loaded
+    with self.evals_lock:
+      self.evals.refresh()
+
+
+class AsyncEvaluator(Evaluator):
+  #asyncio version of Evaluator built on chess.engine
+  #searches are spread across engine_cnt engine processes, at most one
+  #search per engine is in flight and the rest wait for a free engine
+  #evaluations share the same store (and memo_eval rules) as Evaluator
+  #
+  #ev = AsyncEvaluator(engine_cnt=4)
+  #await ev.start()
+  #move, cp = await ev.evaluate_cp(fen, 100)
+  #await ev.quit()
+  def __init__(self, eval_file=None, engine_cnt=None):
+    self.init_evaluator(eval_file, engine_cnt)
+    self.pending = {} #zobrist -> (time, future) for searches in flight
+  def start_engine(self):
+    #the engines are chess.engine processes started by start()
+    raise NotImplementedError("AsyncEvaluator engines are started by start()")
+  def acquire_engine(self):
+    raise NotImplementedError("AsyncEvaluator searches take engines from self.engines")
+  def release_engine(self, engine_info):
+    raise NotImplementedError("AsyncEvaluator searches return engines to self.engines")
+  async def start(self):
+    self.engines = asyncio.Queue()
+    for i in range(self.engine_cnt):
+      transport, engine = await chess.engine.popen_uci(STOCKFISH_BINARY)
+      #see Evaluator.start_engine, newer stockfish versions dropped this option
+      if "Contempt" in engine.options:
+        await engine.configure({"Contempt":0})
+      self.engines.put_nowait(engine)
+  async def quit(self):
+    for i in range(self.engine_cnt):
+      engine = await self.engines.get()
+      await engine.quit()
+    self.save_evals()
+  async def evaluate_depth(self, fen, depth):
+    #won't be saved
+    board = chess.Board(fen)
+    engine = await self.engines.get()
+    try:
+      result = await engine.play(board, chess.engine.Limit(depth=depth), info=chess.engine.INFO_SCORE)
+    finally:
+      self.engines.put_nowait(engine)
+    score = result.info["score"].relative
+    return str(result.move), self.eval_to_centipawns(score.score(), score.mate())
+  async def evaluate_moves_cp(self, fen, moves, time=100):
+    #see Evaluator.evaluate_moves_cp
+    board = chess.Board(fen)
+    engine = await self.engines.get()
+    try:
+      infos = await engine.analyse(board, chess.engine.Limit(time=time/1000), multipv=len(moves), root_moves=[chess.Move.from_uci(move) for move in moves])
+    finally:
+      self.engines.put_nowait(engine)
+    evals = {}
+    for info in infos:
+      score = info["score"].relative
+      evals[info["pv"][0].uci()] = self.eval_to_centipawns(score.score(), score.mate())
+    return evals
+  async def evaluate_cp(self, fen, time=100):
+    move, (cp,mate) = await self.memo_eval(fen, time)
+    return move, self.eval_to_centipawns(cp, mate)
+  async def evaluate_ev(self, fen, time=100):
+    move, (cp, mate) = await self.memo_eval(fen, time)
+    return move, self.eval_to_ev(cp, mate)
+  async def evaluate_many(self, fens, time=100):
+    return await asyncio.gather(*[self.memo_eval(fen, time) for fen in fens])
+  async def evaluate_many_cp(self, fens, time=100):
+    return [(move, self.eval_to_centipawns(cp, mate)) for move, (cp, mate) in await self.evaluate_many(fens, time)]
+  async def evaluate_many_ev(self, fens, time=100):
+    return [(move, self.eval_to_ev(cp, mate)) for move, (cp, mate) in await self.evaluate_many(fens, time)]
+  async def memo_eval(self, fen, time=100):
+    board = chess.Board(fen)
+    zobrist_hash = chess.polyglot.zobrist_hash(board)
+
+    #piggyback on a search of this position that's already running
+    if zobrist_hash in self.pending:
+      pending_time, future = self.pending[zobrist_hash]
+      if pending_time >= time:
+        return await asyncio.shield(future)
+
+    new_time, cached = self.get_new_eval_time(zobrist_hash, time)
+    if new_time is None:
+      return cached
+
+    future = asyncio.get_running_loop().create_future()
+    self.pending[zobrist_hash] = (new_time, future)
+    try:
+      move, evaluation = await self.run_eval(board, new_time)
+      result = self.record_eval(zobrist_hash, new_time, move, evaluation)
+      future.set_result(result)
+    except Exception as e:
+      future.set_exception(e)
+      raise
+    finally:
+      if self.pending.get(zobrist_hash, (None, None))[1] is future:
+        del self.pending[zobrist_hash]
+    return result
+  async def run_eval(self, board, time): #time in millis
+    #returns ev in terms of the side to play
+    engine = await self.engines.get()
+    try:
+      result = await engine.play(board, chess.engine.Limit(time=time/1000), info=chess.engine.INFO_SCORE)
+    finally:
+      self.engines.put_nowait(engine)
+    score = result.info["score"].relative
+    return str(result.move), (score.score(), score.mate())
 
 
 def hash_fen(fen):
@@ -150,7 +336,7 @@ def move_history_to_fen(move_history):
   return board.fen()
 
 if __name__ == "__main__":
-    ev = Evaluator()
+    ev = Evaluator(engine_cnt=1)
 
     position_counts = {}
     #run position counts and evals
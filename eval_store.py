@@ -0,0 +1,192 @@
+import chess
+import numpy as np
+import argparse
+import pickle
+import struct
+import os
+
+#Persistent store of engine evaluations keyed by the 64-bit zobrist hash
+#
+#file layout: a 16 byte header followed by fixed size records
+#the first sorted_cnt records are sorted by zobrist (written by compaction)
+#and are looked up with a binary search on a memory map, so opening the store
+#doesn't load them. Records after that are appended as new evaluations come in
+#and are indexed in memory when the store is opened. Later records win, so
+#reevaluating a position just appends a new record for it
+#
+#compact, merge and migrate rewrite the store and os.replace it, so run them
+#only while nothing else has the store open: records appended during the
+#rewrite are lost, and open stores keep reading the old file
+#
+#usage:
+#python3 eval_store.py compact evals.bin
+#python3 eval_store.py merge evals.bin other_evals.bin [...]
+#python3 eval_store.py migrate evals.pkl evals.bin
+
+MAGIC = b"EVST"
+VERSION = 1
+HEADER = struct.Struct("<4sIQ") #magic, version, sorted record count
+RECORD = struct.Struct("<QdihH") #zobrist, eval_time, cp, mate, move
+RECORD_DTYPE = np.dtype([("zobrist","<u8"), ("eval_time","<f8"), ("cp","<i4"), ("mate","<i2"), ("move","<u2")])
+
+#stand-ins for None, which don't fit in the fixed size fields
+CP_NONE = -2**31
+MATE_NONE = -2**15
+MOVE_NONE = 0xFFFF
+MOVE_NULL = 0xFFFE #the null move "0000", which would otherwise encode as a1a1
+
+def readCL():
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest="command")
+    compact_parser = subparsers.add_parser("compact", help="sort the store and drop superseded records")
+    compact_parser.add_argument("store")
+    merge_parser = subparsers.add_parser("merge", help="merge other stores into the first one")
+    merge_parser.add_argument("store")
+    merge_parser.add_argument("others", nargs="+")
+    migrate_parser = subparsers.add_parser("migrate", help="convert an evals.pkl cache into a store")
+    migrate_parser.add_argument("pickle_file")
+    migrate_parser.add_argument("store")
+    args = parser.parse_args()
+    return args
+
+def encode_move(move):
+    #uci string -> 16 bit code: from square, to square, promotion piece type
+    if move == "None": #no best move, eg checkmate
+        return MOVE_NONE
+    move = chess.Move.from_uci(move)
+    if not move:
+        return MOVE_NULL
+    return move.from_square | (move.to_square << 6) | ((move.promotion or 0) << 12)
+
+def decode_move(code):
+    if code == MOVE_NONE:
+        return "None"
+    if code == MOVE_NULL:
+        return chess.Move.null().uci()
+    return chess.Move(code & 63, (code >> 6) & 63, (code >> 12) or None).uci()
+
+def pack_eval_info(eval_info):
+    cp, mate = eval_info["eval"]
+    return RECORD.pack(eval_info["zobrist"],
+                       eval_info["eval_time"],
+                       CP_NONE if cp is None else cp,
+                       MATE_NONE if mate is None else mate,
+                       encode_move(eval_info["move"]))
+
+def unpack_eval_info(zobrist, eval_time, cp, mate, move):
+    return {
+        "zobrist": int(zobrist),
+        "eval_time": float(eval_time),
+        "eval": (None if cp == CP_NONE else int(cp), None if mate == MATE_NONE else int(mate)),
+        "move": decode_move(int(move))
+    }
+
+class EvalStore():
+    def __init__(self, filename):
+        self.filename = filename
+        if not os.path.exists(filename):
+            write_records(filename, np.zeros(0, dtype=RECORD_DTYPE))
+        #append mode so stores opened by several processes (eg the opening_book
+        #workers) add their records after each other's instead of over them
+        self.f = open(filename, "a+b")
+        self.f.seek(0)
+        magic, version, self.sorted_cnt = HEADER.unpack(self.f.read(HEADER.size))
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(f"{filename} is not an evaluation store")
+
+        #drop a partially written record left by a crash mid-append
+        size = os.fstat(self.f.fileno()).st_size
+        record_cnt = (size - HEADER.size) // RECORD.size
+        if HEADER.size + record_cnt * RECORD.size != size:
+            self.f.truncate(HEADER.size + record_cnt * RECORD.size)
+
+        if self.sorted_cnt > 0:
+            self.sorted_records = np.memmap(filename, dtype=RECORD_DTYPE, mode="r", offset=HEADER.size, shape=(self.sorted_cnt,))
+            self.sorted_keys = self.sorted_records["zobrist"]
+        else:
+            self.sorted_records = None
+
+        #zobrist -> eval_info for records appended since the last compaction
+        self.tail = {}
+        self.indexed_size = HEADER.size + self.sorted_cnt * RECORD.size #file offset tail has been read up to
+        self.refresh()
+    def refresh(self):
+        #index the records appended since the store was opened or last refreshed,
+        #including those appended by other processes (eg the opening_book workers)
+        size = os.fstat(self.f.fileno()).st_size
+        record_cnt = (size - self.indexed_size) // RECORD.size
+        if record_cnt > 0:
+            tail_records = np.fromfile(self.filename, dtype=RECORD_DTYPE, count=record_cnt, offset=self.indexed_size)
+            for record in tail_records:
+                eval_info = unpack_eval_info(*record)
+                self.tail[eval_info["zobrist"]] = eval_info
+            self.indexed_size += record_cnt * RECORD.size
+        self.f.seek(0, os.SEEK_END)
+    def get(self, zobrist):
+        if zobrist in self.tail:
+            return self.tail[zobrist]
+        if self.sorted_records is None:
+            return None
+        i = np.searchsorted(self.sorted_keys, np.uint64(zobrist))
+        if i < self.sorted_cnt and self.sorted_keys[i] == zobrist:
+            return unpack_eval_info(*self.sorted_records[i])
+        return None
+    def put(self, eval_info):
+        #append immediately so a crash loses at most the current evaluation
+        self.f.write(pack_eval_info(eval_info))
+        self.f.flush()
+        self.tail[eval_info["zobrist"]] = dict(eval_info)
+    def __contains__(self, zobrist):
+        return self.get(zobrist) is not None
+    def __getitem__(self, zobrist):
+        eval_info = self.get(zobrist)
+        if eval_info is None:
+            raise KeyError(zobrist)
+        return eval_info
+    def flush(self):
+        self.f.flush()
+    def close(self):
+        self.f.close()
+
+def read_records(filename):
+    return np.fromfile(filename, dtype=RECORD_DTYPE, offset=HEADER.size)
+
+def write_records(filename, records):
+    #records must already be sorted by zobrist with no duplicates
+    #write to a temp file and rename so readers never see a partial store
+    tmp_filename = filename + ".tmp"
+    with open(tmp_filename, "wb") as f_out:
+        f_out.write(HEADER.pack(MAGIC, VERSION, len(records)))
+        records.tofile(f_out)
+    os.replace(tmp_filename, filename)
+
+def latest_records(records):
+    #for each zobrist keep the longest evaluation, breaking ties by the latest record
+    order = np.lexsort((np.arange(len(records)), records["eval_time"], records["zobrist"]))
+    records = records[order]
+    is_last = np.ones(len(records), dtype=bool)
+    is_last[:-1] = records["zobrist"][1:] != records["zobrist"][:-1]
+    return records[is_last]
+
+def compact_store(filename, other_filenames=[]):
+    #no other process may have filename open, see the top of the file
+    records = np.concatenate([read_records(f) for f in [filename] + list(other_filenames)])
+    write_records(filename, latest_records(records))
+
+def migrate_pickle(pickle_file, filename):
+    evals = pickle.load(open(pickle_file, "rb"))
+    records = np.frombuffer(b"".join(pack_eval_info(x) for x in evals.values() if x["eval_time"] > 0), dtype=RECORD_DTYPE)
+    if os.path.exists(filename):
+        records = np.concatenate([read_records(filename), records])
+    write_records(filename, latest_records(records))
+
+if __name__ == "__main__":
+    args = readCL()
+    if args.command == "compact":
+        compact_store(args.store)
+    elif args.command == "merge":
+        compact_store(args.store, args.others)
+    elif args.command == "migrate":
+        migrate_pickle(args.pickle_file, args.store)
+    else:
+        raise Exception(f"unknown command: {args.command}")
@@ -0,0 +1,214 @@
+import numpy as np
+import hashlib
+import json
+import os
+import weakref
+import collections.abc
+
+from eval_store import encode_move, decode_move
+
+#Compiled version of the opening_book game tree (the GameNode graph)
+#
+#positions are numbered 0..n-1 and the edges out of position i are
+#edges [child_offsets[i], child_offsets[i+1]) (compressed sparse rows)
+#each array is a .npy file in the graph directory and is memory mapped
+#when loaded, so a saved graph is ready to use without reading positions.csv
+#
+#GraphNode has the GameNode interface (val, children, moves, probs, total_cnt,
+#is_leaf, get_ev) so the opening book DP (compute_books) runs on either one
+#
+#views only hold the ids of other positions, not their views, so positions
+#the DP is done with can be freed instead of the whole tree staying in memory
+
+ARRAYS = ["fen_offsets", "fen_blob", "fen_hashes", "fen_hash_ids", "child_offsets", "child_ids", "child_moves", "child_probs", "child_cnts", "total_cnts"]
+
+def fen_hash(fen):
+    return int.from_bytes(hashlib.blake2b(fen.encode(), digest_size=8).digest(), "little")
+
+def source_info(source_file, config):
+    #what a saved graph was built from, to tell when it's out of date
+    stat = os.stat(source_file)
+    return {"source_file": os.path.abspath(source_file), "source_size": stat.st_size, "source_mtime": stat.st_mtime, "config": config}
+
+def build_game_graph(nodes, positions, graph_dir, source_file, config=""):
+    #nodes: fen -> GameNode and positions: fen -> info as from generate_game_tree and generate_position_stats
+    #config: anything besides source_file that the probabilities depend on
+    ids = {fen: i for i, fen in enumerate(nodes)}
+    fens = [fen.encode() for fen in nodes]
+    fen_offsets = np.zeros(len(fens) + 1, dtype=np.int64)
+    fen_offsets[1:] = np.cumsum([len(fen) for fen in fens])
+    fen_hashes = np.array([fen_hash(fen) for fen in nodes], dtype=np.uint64)
+    fen_hash_ids = np.argsort(fen_hashes, kind="stable").astype(np.int32)
+
+    child_offsets = np.zeros(len(nodes) + 1, dtype=np.int64)
+    child_ids = []
+    child_moves = []
+    child_probs = []
+    child_cnts = []
+    total_cnts = np.zeros(len(nodes), dtype=np.int64)
+    for i, (fen, node) in enumerate(nodes.items()):
+        move_cnts = positions[fen]["move_cnts"]
+        for child in node.children:
+            move = node.moves[child]
+            child_ids.append(ids[child.val])
+            child_moves.append(encode_move(move))
+            child_probs.append(node.probs[child])
+            child_cnts.append(move_cnts.get(move, 0))
+        child_offsets[i+1] = len(child_ids)
+        total_cnts[i] = node.total_cnt
+
+    arrays = {
+        "fen_offsets": fen_offsets,
+        "fen_blob": np.frombuffer(b"".join(fens), dtype=np.uint8),
+        "fen_hashes": fen_hashes[fen_hash_ids],
+        "fen_hash_ids": fen_hash_ids,
+        "child_offsets": child_offsets,
+        "child_ids": np.array(child_ids, dtype=np.int32),
+        "child_moves": np.array(child_moves, dtype=np.uint16),
+        "child_probs": np.array(child_probs, dtype=np.float32),
+        "child_cnts": np.array(child_cnts, dtype=np.uint32),
+        "total_cnts": total_cnts
+    }
+    os.makedirs(graph_dir, exist_ok=True)
+    for name in ARRAYS:
+        np.save(os.path.join(graph_dir, name + ".npy"), arrays[name])
+    with open(os.path.join(graph_dir, "meta.json"), "w") as f_out:
+        json.dump(source_info(source_file, config), f_out)
+
+class GameGraph():
+    def __init__(self, graph_dir, get_ev=None):
+        #get_ev(node, optimism): leaf evaluation used by GraphNode.get_ev
+        self.graph_dir = graph_dir
+        self.get_ev = get_ev
+        for name in ARRAYS:
+            setattr(self, name, np.load(os.path.join(graph_dir, name + ".npy"), mmap_mode="r"))
+        self.views = weakref.WeakValueDictionary() #id -> GraphNode while it's in use, so each position has one view
+        self.probs_overrides = {} #id -> EdgeMap set through GraphNode.probs
+    @staticmethod
+    def is_current(graph_dir, source_file, config=""):
+        meta_file = os.path.join(graph_dir, "meta.json")
+        if not os.path.exists(meta_file):
+            return False
+        with open(meta_file) as f:
+            return json.load(f) == json.loads(json.dumps(source_info(source_file, config)))
+    def __len__(self):
+        return len(self.total_cnts)
+    def node(self, i):
+        node = self.views.get(i)
+        if node is None:
+            node = self.views[i] = GraphNode(self, i)
+        return node
+    def fen_id(self, fen):
+        h = np.uint64(fen_hash(fen))
+        i = np.searchsorted(self.fen_hashes, h)
+        while i < len(self.fen_hashes) and self.fen_hashes[i] == h:
+            node_id = int(self.fen_hash_ids[i])
+            if self.fen(node_id) == fen:
+                return node_id
+            i += 1
+        raise KeyError(fen)
+    def fen(self, i):
+        return bytes(self.fen_blob[self.fen_offsets[i]:self.fen_offsets[i+1]]).decode()
+    def __getitem__(self, fen):
+        #same as nodes[fen] for the dict from generate_game_tree
+        return self.node(self.fen_id(fen))
+    def __contains__(self, fen):
+        try:
+            self.fen_id(fen)
+            return True
+        except KeyError:
+            return False
+    def edges(self, i):
+        return range(int(self.child_offsets[i]), int(self.child_offsets[i+1]))
+    def move_cnts(self, i):
+        #{move: cnt} as in generate_position_stats, without the best move edges nobody played
+        return {decode_move(int(self.child_moves[e])): int(self.child_cnts[e]) for e in self.edges(i) if self.child_cnts[e] > 0}
+
+class EdgeMap(collections.abc.Mapping):
+    #{child node: value} for the edges out of a position, stored by child id
+    #so it doesn't keep the child views alive
+    __slots__ = ["graph", "values"]
+    def __init__(self, graph, child_ids, values):
+        self.graph = graph
+        self.values = dict(zip(child_ids, values))
+    def __getitem__(self, child):
+        return self.values[child.id]
+    def __iter__(self):
+        return (self.graph.node(i) for i in self.values)
+    def __len__(self):
+        return len(self.values)
+    def __repr__(self):
+        return repr(self.values)
+
+class GraphNode():
+    #view of one position of a GameGraph with the GameNode interface
+    __slots__ = ["graph", "id", "_val", "_moves", "_probs", "__weakref__"]
+    def __init__(self, graph, i):
+        self.graph = graph
+        self.id = i
+        self._val = None
+        self._moves = None
+        self._probs = None
+    @property
+    def val(self):
+        if self._val is None:
+            self._val = self.graph.fen(self.id)
+        return self._val
+    @property
+    def total_cnt(self):
+        return int(self.graph.total_cnts[self.id])
+    def child_ids(self):
+        edges = self.graph.edges(self.id)
+        return [int(i) for i in self.graph.child_ids[edges.start:edges.stop]]
+    @property
+    def children(self):
+        return [self.graph.node(i) for i in self.child_ids()]
+    @property
+    def moves(self):
+        if self._moves is None:
+            edges = self.graph.edges(self.id)
+            codes = self.graph.child_moves[edges.start:edges.stop]
+            self._moves = EdgeMap(self.graph, self.child_ids(), [decode_move(int(code)) for code in codes])
+        return self._moves
+    @property
+    def probs(self):
+        if self.id in self.graph.probs_overrides:
+            return self.graph.probs_overrides[self.id]
+        if self._probs is None:
+            edges = self.graph.edges(self.id)
+            probs = self.graph.child_probs[edges.start:edges.stop]
+            self._probs = EdgeMap(self.graph, self.child_ids(), [float(prob) for prob in probs])
+        return self._probs
+    @probs.setter
+    def probs(self, probs):
+        #overrides the saved probabilities of this position in this GameGraph, not on disk
+        self.graph.probs_overrides[self.id] = EdgeMap(self.graph, [child.id for child in probs], list(probs.values()))
+    @property
+    def move_cnts(self):
+        return self.graph.move_cnts(self.id)
+    def is_leaf(self):
+        return self.graph.child_offsets[self.id] == self.graph.child_offsets[self.id+1]
+    def get_ev(self, optimism):
+        if self.is_leaf():
+            return self.graph.get_ev(self, optimism)
+        else:
+            raise
+    def __eq__(self, other):
+        return isinstance(other, GraphNode) and self.graph is other.graph and self.id == other.id
+    def __hash__(self):
+        return self.id
+    def __str__(self):
+        return str(self.val) + '\n' + str(self.probs)
+
+class GraphPositions():
+    #positions[fen] lookups (fen, move_cnts, total_cnt) like the dict from
+    #generate_position_stats, for code like print_book that reads them
+    def __init__(self, graph):
+        self.graph = graph
+    def __getitem__(self, fen):
+        node = self.graph[fen]
+        return {"fen": fen, "move_cnts": node.move_cnts, "total_cnt": node.total_cnt}
+    def __contains__(self, fen):
+        return fen in self.graph
+    def __len__(self):
+        return len(self.graph)
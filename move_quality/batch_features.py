@@ -0,0 +1,58 @@
+import chess
+import numpy as np
+
+#material and phase features computed with numpy for many positions at once
+#(a whole game or a chunk of the corpus) instead of one fen at a time
+#positions are rows of 12 piece bitboards (uint64), columns are
+#white pawn, knight, bishop, rook, queen, king then the same for black
+
+PIECE_TYPES = [chess.PAWN, chess.KNIGHT, chess.BISHOP, chess.ROOK, chess.QUEEN, chess.KING]
+
+#endgame piece values, same as compute_features.get_material_difference
+MATERIAL_VALUES = np.array([208, 865, 918, 1378, 2687, 0], dtype=np.int64)
+
+#middlegame non-pawn piece values and limits from the stockfish phase
+#computation in stockfish_features.js
+PHASE_VALUES = np.array([0, 782, 830, 1289, 2529, 0], dtype=np.int64)
+MIDGAME_LIMIT = 15258
+ENDGAME_LIMIT = 3915
+
+def board_bitboards(board):
+    return [board.pieces_mask(piece_type, color) for color in [chess.WHITE, chess.BLACK] for piece_type in PIECE_TYPES]
+
+def game_bitboards(game):
+    #bitboards and side to play (1 white, -1 black) before each mainline move
+    #of a chess.pgn.Game, ie the same positions as pgn_to_moves.Game.moves()
+    board = game.board()
+    bitboards = []
+    turns = []
+    for move in game.mainline_moves():
+        bitboards.append(board_bitboards(board))
+        turns.append(1 if board.turn else -1)
+        board.push(move)
+    return np.array(bitboards, dtype=np.uint64).reshape(-1, 12), np.array(turns, dtype=np.int64)
+
+def popcount(x):
+    #bit counts of a uint64 array
+    x = x - ((x >> np.uint64(1)) & np.uint64(0x5555555555555555))
+    x = (x & np.uint64(0x3333333333333333)) + ((x >> np.uint64(2)) & np.uint64(0x3333333333333333))
+    x = (x + (x >> np.uint64(4))) & np.uint64(0x0f0f0f0f0f0f0f0f)
+    return ((x * np.uint64(0x0101010101010101)) >> np.uint64(56)).astype(np.int64)
+
+def piece_counts(bitboards):
+    #(n, 12) counts of each piece, columns as in the bitboards
+    return popcount(bitboards)
+
+def material_difference(bitboards, turns):
+    #same as compute_features.get_material_difference for each position
+    #from the perspective of the side to play
+    counts = piece_counts(bitboards)
+    return ((counts[:, :6] - counts[:, 6:]) @ MATERIAL_VALUES) * turns
+
+def game_phase(bitboards):
+    #stockfish game phase scaled to [0, 1], 1 is the middlegame
+    #same as the "phase" feature from compute_features.get_stockfish_features
+    counts = piece_counts(bitboards)
+    npm = (counts[:, :6] + counts[:, 6:]) @ PHASE_VALUES
+    npm = np.clip(npm, ENDGAME_LIMIT, MIDGAME_LIMIT)
+    return ((npm - ENDGAME_LIMIT) * 128 // (MIDGAME_LIMIT - ENDGAME_LIMIT)) / 128
@@ -1,15 +1,18 @@
-from compute_features import compute_all_features
+from compute_features import compute_all_features, compute_all_features_async
 from pgn_to_moves import pgn_to_games
+from eval_moves import AsyncEvaluator
 import chess
 import chess.pgn
 import csv
 import argparse
 import sys
+import asyncio
 
 def readCL():
     parser = argparse.ArgumentParser()
     parser.add_argument('-f','--infile')
     parser.add_argument('-v','--verbose', action="store_true")
+    parser.add_argument('--engines', type=int, default=0, help="evaluate with an asyncio engine pool of this size, overlapping parsing and searches")
     args = parser.parse_args()
     return args
 
@@ -53,75 +56,111 @@ def compute_move_score(features, baseline_elo = None):
 
     return move_score
 
+def get_game_scores(game, moves, all_features, verbose):
+    move_scores = {"white":[], "black":[]}
+    move_scores_2600 = {"white":[], "black":[]}
+    move_scores_2800 = {"white":[], "black":[]}
+
+    #print(game.headers())
+    for move, features in zip(moves, all_features):
+        move_score = compute_move_score(features)
+        move_score_2600 = compute_move_score(features, 2600)
+        move_score_2800 = compute_move_score(features, 2800)
+        if (verbose):
+            print(move_score, move_score_2600, move_score_2800)
+            print(features)
+            print(move["fen"],move["move"],move_score,features["eval"], features["loss"])
+
+        if move["turn"] == 1:
+            move_scores["white"].append(move_score)
+            move_scores_2600["white"].append(move_score_2600)
+            move_scores_2800["white"].append(move_score_2800)
+
+            # print(move["fen"], move["move"])
+            # print(features["eval"])
+            # print(features["loss"])
+            # print(features["loss_8"])
+            # print(move_score,move_score_2600,move_score_2800)
+        else:
+            move_scores["black"].append(move_score)
+            move_scores_2600["black"].append(move_score_2600)
+            move_scores_2800["black"].append(move_score_2800)
+
+    info = {
+        "event": game.headers()["Event"],
+        "round": game.headers()["Round"],
+        "white": game.headers()["White"],
+        "black": game.headers()["Black"],
+    }
+
+    avg_score_white = sum(move_scores["white"]) / len(move_scores["white"])
+    avg_score_black = sum(move_scores["black"]) / len(move_scores["black"])
+
+    total_score_2600_white = sum(move_scores_2600["white"])
+    total_score_2600_black = sum(move_scores_2600["black"])
+
+    total_score_2800_white = sum(move_scores_2800["white"])
+    total_score_2800_black = sum(move_scores_2800["black"])
+
+    info_white = {
+        **info,
+        "player":game.headers()["White"],
+        "avg_score": avg_score_white,
+        "total_score_2600": total_score_2600_white,
+        "total_score_2800": total_score_2800_white
+    }
+
+    info_black = {
+        **info,
+        "player":game.headers()["Black"],
+        "avg_score": avg_score_black,
+        "total_score_2600": total_score_2600_black,
+        "total_score_2800": total_score_2800_black
+    }
+
+    return info_white, info_black
+
+async def compute_games_async(games, engine_cnt, verbose, writer):
+    #compute features for up to 2 * engine_cnt games at a time so the next games
+    #are being parsed and searched while earlier games are scored and written
+    aev = AsyncEvaluator(engine_cnt=engine_cnt)
+    await aev.start()
+
+    async def compute_game(game):
+        moves = list(game.moves())
+        all_features = await asyncio.gather(*[compute_all_features_async(aev, move["fen"], move["move"]) for move in moves])
+        return game, moves, all_features
+
+    tasks = []
+    def write_next():
+        game, moves, all_features = tasks.pop(0).result()
+        for info in get_game_scores(game, moves, all_features, verbose):
+            writer.writerow(info)
+        sys.stdout.flush()
+
+    for game in games:
+        tasks.append(asyncio.ensure_future(compute_game(game)))
+        while tasks and (len(tasks) >= 2 * engine_cnt or tasks[0].done()):
+            await asyncio.wait([tasks[0]])
+            write_next()
+        await asyncio.sleep(0) #let the searches run between games
+    while tasks:
+        await asyncio.wait([tasks[0]])
+        write_next()
+    await aev.quit()
+
 if __name__ == "__main__":
     args = readCL()
 
     fieldnames = ["event", "round", "white", "black", "player", "avg_score", "total_score_2600", "total_score_2800"]
     writer = csv.DictWriter(sys.stdout, fieldnames=fieldnames)
     writer.writeheader()
-    for game in pgn_to_games(args.infile, high_elo=True):
-        move_scores = {"white":[], "black":[]}
-        move_scores_2600 = {"white":[], "black":[]}
-        move_scores_2800 = {"white":[], "black":[]}
-
-        #print(game.headers())
-        for move in game.moves():
-            features = compute_all_features(move["fen"], move["move"])
-            move_score = compute_move_score(features)
-            move_score_2600 = compute_move_score(features, 2600)
-            move_score_2800 = compute_move_score(features, 2800)
-            if (args.verbose):
-                print(move_score, move_score_2600, move_score_2800)
-                print(features)
-                print(move["fen"],move["move"],move_score,features["eval"], features["loss"])
-
-            if move["turn"] == 1:
-                move_scores["white"].append(move_score)
-                move_scores_2600["white"].append(move_score_2600)
-                move_scores_2800["white"].append(move_score_2800)
-
-                # print(move["fen"], move["move"])
-                # print(features["eval"])
-                # print(features["loss"])
-                # print(features["loss_8"])
-                # print(move_score,move_score_2600,move_score_2800)
-            else:
-                move_scores["black"].append(move_score)
-                move_scores_2600["black"].append(move_score_2600)
-                move_scores_2800["black"].append(move_score_2800)
-
-        info = {
-            "event": game.headers()["Event"],
-            "round": game.headers()["Round"],
-            "white": game.headers()["White"],
-            "black": game.headers()["Black"],
-        }
-
-        avg_score_white = sum(move_scores["white"]) / len(move_scores["white"])
-        avg_score_black = sum(move_scores["black"]) / len(move_scores["black"])
-
-        total_score_2600_white = sum(move_scores_2600["white"])
-        total_score_2600_black = sum(move_scores_2600["black"])
-
-        total_score_2800_white = sum(move_scores_2800["white"])
-        total_score_2800_black = sum(move_scores_2800["black"])
-
-        info_white = {
-            **info,
-            "player":game.headers()["White"],
-            "avg_score": avg_score_white,
-            "total_score_2600": total_score_2600_white,
-            "total_score_2800": total_score_2800_white
-        }
-
-        info_black = {
-            **info,
-            "player":game.headers()["Black"],
-            "avg_score": avg_score_black,
-            "total_score_2600": total_score_2600_black,
-            "total_score_2800": total_score_2800_black
-        }
-
-        writer.writerow(info_white)
-        writer.writerow(info_black)
-        sys.stdout.flush()
+    if args.engines:
+        asyncio.run(compute_games_async(pgn_to_games(args.infile, high_elo=True), args.engines, args.verbose, writer))
+    else:
+        for game in pgn_to_games(args.infile, high_elo=True):
+            moves = list(game.moves())
+            all_features = [compute_all_features(move["fen"], move["move"]) for move in moves]
+            for info in get_game_scores(game, moves, all_features, args.verbose):
+                writer.writerow(info)
+            sys.stdout.flush()
@@ -7,17 +7,36 @@ import csv
 from eval_moves import Evaluator, fen_plus_move
 import chess
 import subprocess
+import math
 import json
 import sys
+import asyncio
+import os
+import queue
+import threading
+import concurrent.futures
+import atexit
 
-ev = Evaluator()
+ev = Evaluator(engine_cnt=1)
 
 INPUT_FILE = "/tmp/pred_data.csv"
 OUTPUT_FILE = "/tmp/test.csv" #chess_features.csv"
+FEATURES_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "stockfish_features.js")
+FEATURE_WORKER_CNT = os.cpu_count() or 1
+
+#compute losses from a single MultiPV search of the position restricted to
+#the best and the played move (see Evaluator.evaluate_moves_cp), instead of
+#searching the position and the positions after both the best and the played move.
+#NOTE: the coefficients in compute_best_played_games.py were fit on losses
+#from the three search version
+SINGLE_SEARCH_LOSS = False
 
 #loss feature
 def compute_loss(fen, move, eval_time_millis = 100):
     #returns eval, loss
+    if SINGLE_SEARCH_LOSS:
+        return compute_loss_single_search(fen, move, eval_time_millis)
+
     best_move, _ = ev.evaluate_cp(fen, eval_time_millis) #TODO: maybe should return this eval instead of throwing it away and using "best_eval" below, which is from the other player's perspective
     best_move_fen = fen_plus_move(fen, best_move)
     _, best_eval = ev.evaluate_cp(best_move_fen, eval_time_millis)
@@ -28,6 +47,32 @@ def compute_loss(fen, move, eval_time_millis = 100):
     #-1 to flip to the perspective of the player currently to play
     return -1 * best_eval, -1 * (best_eval - observed_eval)
 
+def single_search_loss(evals, move):
+    #eval, loss from the evaluate_moves_cp evals of the best and the played move
+    #the restricted search can find the played move is the better of the two
+    best_eval = max(evals.values())
+    return best_eval, best_eval - evals[move]
+
+def compute_loss_single_search(fen, move, eval_time_millis = 100):
+    #evals here are from the perspective of the player to play
+    #the cached search only picks the best move, both evals come from the same search
+    best_move, _ = ev.evaluate_cp(fen, eval_time_millis)
+    evals = ev.evaluate_moves_cp(fen, list(dict.fromkeys([best_move, move])), eval_time_millis)
+    return single_search_loss(evals, move)
+
+async def compute_loss_async(aev, fen, move, eval_time_millis = 100):
+    #same as compute_loss using an AsyncEvaluator
+    if SINGLE_SEARCH_LOSS:
+        best_move, _ = await aev.evaluate_cp(fen, eval_time_millis)
+        evals = await aev.evaluate_moves_cp(fen, list(dict.fromkeys([best_move, move])), eval_time_millis)
+        return single_search_loss(evals, move)
+
+    best_move, _ = await aev.evaluate_cp(fen, eval_time_millis)
+    (_, best_eval), (_, observed_eval) = await asyncio.gather(
+        aev.evaluate_cp(fen_plus_move(fen, best_move), eval_time_millis),
+        aev.evaluate_cp(fen_plus_move(fen, move), eval_time_millis))
+    return -1 * best_eval, -1 * (best_eval - observed_eval)
+
 
 #TODO: previously was computing each eval only once
 #now rerun feature generation and regressions with this
@@ -45,36 +90,139 @@ def compute_all_features(position, move):
     features["eval"] = eval_
     features["loss"] = loss
 
+    #the low depth searches mostly agree on the same few moves
+    #so only compute the loss once for each of them
+    move_losses = {move: loss}
     for depth_info in EVAL_DEPTHS:
         #lower depths are noisy, so compute them multiple times and average
         total_loss = 0
         for i in range(depth_info["cnt"]):
             best_move_at_depth, _ = ev.evaluate_depth(position,depth_info["depth"])
-            _, loss = compute_loss(position, best_move_at_depth, TIME_MILLIS)
-            total_loss += loss
+            if best_move_at_depth not in move_losses:
+                _, move_losses[best_move_at_depth] = compute_loss(position, best_move_at_depth, TIME_MILLIS)
+            total_loss += move_losses[best_move_at_depth]
         features["loss_"+str(depth_info["depth"])] = total_loss / depth_info["cnt"]
 
     stockfish_features = get_stockfish_features(position)
+    add_stockfish_features(features, position, stockfish_features)
+    return features
+
+async def compute_all_features_async(aev, position, move):
+    #same as compute_all_features using an AsyncEvaluator
+    #all the searches for the row are issued at once, so they run in parallel
+    #across aev's engines and overlap with the stockfish feature subprocess
+    TIME_MILLIS = 100
+    features = {}
+
+    async def depth_loss(depth):
+        best_move_at_depth, _ = await aev.evaluate_depth(position, depth)
+        _, loss = await compute_loss_async(aev, position, best_move_at_depth, TIME_MILLIS)
+        return loss
+
+    depths = [depth_info["depth"] for depth_info in EVAL_DEPTHS for i in range(depth_info["cnt"])]
+    stockfish_task = asyncio.ensure_future(asyncio.to_thread(get_stockfish_features, position))
+    (eval_, loss), *depth_losses = await asyncio.gather(compute_loss_async(aev, position, move, TIME_MILLIS), *[depth_loss(d) for d in depths])
+    features["eval"] = eval_
+    features["loss"] = loss
+
+    for depth_info in EVAL_DEPTHS:
+        #lower depths are noisy, so compute them multiple times and average
+        losses = [l for d,l in zip(depths, depth_losses) if d == depth_info["depth"]]
+        features["loss_"+str(depth_info["depth"])] = sum(losses) / depth_info["cnt"]
+
+    add_stockfish_features(features, position, await stockfish_task)
+    return features
 
+def add_stockfish_features(features, position, stockfish_features):
     features["phase"] = stockfish_features['other_features']['phase']
     features['scale_factor'] = stockfish_features['other_features']['scale_factor']
     features['static_eval'] = stockfish_features['eval_features']['total']
     features['king_danger'] = stockfish_features['eval_features']['king_danger']
     features["opening"] = 1*(float(position.split()[-1]) < 10)
-    return features
 
-def get_stockfish_features(position):
-    #TODO: all features are from white perspective, need to flip to the perspective of the side to play
-    output = subprocess.run(['node', 'stockfish_features.js',position],stdout=subprocess.PIPE).stdout
-    feature_obj = json.loads(output)
+class FeatureWorkerPool():
+    #long running `node stockfish_features.js` processes that each take
+    #one fen per line on stdin and answer with one json object per line
+    #workers that die are restarted and their batch is retried once
+    def __init__(self, worker_cnt=None):
+        self.worker_cnt = worker_cnt if worker_cnt else FEATURE_WORKER_CNT
+        self.workers = [None] * self.worker_cnt
+        self.free_workers = queue.Queue()
+        for i in range(self.worker_cnt):
+            self.free_workers.put(i)
+    def get_worker(self, i):
+        if self.workers[i] is None or self.workers[i].poll() is not None:
+            self.workers[i] = subprocess.Popen(['node', FEATURES_SCRIPT], stdin=subprocess.PIPE, stdout=subprocess.PIPE, text=True)
+        return self.workers[i]
+    def write_positions(self, worker, positions):
+        try:
+            worker.stdin.write("".join(position + "\n" for position in positions))
+            worker.stdin.flush()
+        except BrokenPipeError:
+            pass #the reader sees the worker die and retries
+    def run_batch(self, positions):
+        i = self.free_workers.get()
+        try:
+            for attempt in range(2):
+                worker = self.get_worker(i)
+                #write from a separate thread: if we wrote the whole batch before reading
+                #then a full stdout pipe would block the worker and deadlock us
+                writer = threading.Thread(target=self.write_positions, args=(worker, positions))
+                writer.start()
+                lines = [worker.stdout.readline() for position in positions]
+                writer.join()
+                if all(line.endswith("\n") for line in lines):
+                    feature_objs = [json.loads(line) for line in lines]
+                    for position, feature_obj in zip(positions, feature_objs):
+                        if "error" in feature_obj:
+                            raise Exception(f"stockfish features failed for {position}: {feature_obj['error']}")
+                    return feature_objs
+                worker.kill()
+                worker.wait()
+                self.workers[i] = None
+            raise Exception("stockfish feature worker died twice on the same batch")
+        finally:
+            self.free_workers.put(i)
+    def get_features(self, positions):
+        chunk_size = max(1, math.ceil(len(positions) / self.worker_cnt))
+        chunks = [positions[i:i+chunk_size] for i in range(0, len(positions), chunk_size)]
+        if len(chunks) <= 1:
+            return self.run_batch(positions) if positions else []
+        with concurrent.futures.ThreadPoolExecutor(max_workers=len(chunks)) as executor:
+            return [feature_obj for chunk in executor.map(self.run_batch, chunks) for feature_obj in chunk]
+    def close(self):
+        #closing stdin ends the node process's input loop so it exits
+        for i, worker in enumerate(self.workers):
+            if worker is not None:
+                try:
+                    worker.stdin.close()
+                except BrokenPipeError:
+                    pass
+                worker.wait()
+                self.workers[i] = None
+
+feature_workers = None
 
-    #stockfish features are from white's perspective
-    #adjust for side to play
-    turn = get_turn(position)
-    for k in feature_obj['eval_features']:
-        feature_obj['eval_features'][k] *= turn
-
-    return feature_obj
+def get_stockfish_features(position):
+    return get_stockfish_features_many([position])[0]
+
+def get_stockfish_features_many(positions):
+    #batched version of get_stockfish_features, run on the pool of node workers
+    global feature_workers
+    if feature_workers is None:
+        feature_workers = FeatureWorkerPool()
+        atexit.register(feature_workers.close)
+
+    positions = list(positions)
+    feature_objs = feature_workers.get_features(positions)
+    for position, feature_obj in zip(positions, feature_objs):
+        #stockfish features are from white's perspective
+        #adjust for side to play
+        turn = get_turn(position)
+        for k in feature_obj['eval_features']:
+            feature_obj['eval_features'][k] *= turn
+
+    return feature_objs
 
 def get_material_difference(position):
     #to compute faster than running the stockfish features
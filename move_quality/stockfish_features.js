@@ -276,4 +276,21 @@ function getFeatures(fen) {
   return out;
 }
 
-console.log(JSON.stringify(getFeatures(process.argv[2])));
+if (process.argv.length > 2) {
+  console.log(JSON.stringify(getFeatures(process.argv[2])));
+} else {
+  //worker mode: read one fen per line on stdin and write one json object per line
+  //to stdout, so a single process can be reused for many positions
+  const readline = require('readline');
+  const rl = readline.createInterface({input: process.stdin});
+  rl.on('line', (fen) => {
+    let out;
+    try {
+      out = getFeatures(fen);
+    }
+    catch (e) {
+      out = {error: e.message};
+    }
+    process.stdout.write(JSON.stringify(out) + "\n");
+  });
+}
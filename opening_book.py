@@ -13,6 +13,7 @@
 #on stockfish evals
 
 from eval_moves import Evaluator, hash_fen, fen_plus_move, move_history_to_fen
+from game_graph import GameGraph, GraphPositions, build_game_graph
 import csv
 from jtutils import pairwise
 import sys
@@ -24,43 +25,188 @@ import numpy as np
 import itertools
 import time
 import shelve
+import heapq
+import array
 import os
 import random
+import re
+import multiprocessing
+import queue
+import concurrent.futures
+
+EVAL_ENGINE_CNT = os.cpu_count() or 1 #engines for EVALUATOR, which prefetch_evaluations runs across. they start on the first search
+PREFETCH_TIME_BUDGET = None #seconds prefetch_evaluations can spend, None for no limit
 
 #read the graph of positions, along with the ev
-EVALUATOR = Evaluator()
+EVALUATOR = Evaluator(engine_cnt=EVAL_ENGINE_CNT)
 
 INPUT_FILE = "/ssd/files/chess/filtered_moves.csv"
+STATS_WORKER_CNT = os.cpu_count() or 1 #processes parsing INPUT_FILE in generate_position_stats
+STATS_CHUNK_ROWS = 1000
+MOVE_CNT_RE = re.compile(r"'([^']*)': (\d+)")
+MOVE_LIST_RE = re.compile(r"'([^']*)'")
+GAME_GRAPH_DIR = INPUT_FILE + ".graph" #compiled game tree, see game_graph.py
 EVAL_TIME = 1000
 
-CACHE_STATS = {}
+REFINE_TIME_BUDGET = 600 #wall clock seconds each round of refine_evaluations can spend, None for no limit
+REFINE_ENGINE_BUDGET = None #engine seconds each round of refine_evaluations can spend, None for no limit
+REFINE_MAX_EVAL_TIME = 8000 * EVAL_TIME #longest search refine_evaluations runs on a leaf
+REFINE_LEAF_CNT = 250 #most likely leaves of each book that refine_evaluations considers
+
+MAX_MEMORY_CACHED_MOVES = 1000 * 2000 #2000 superbooks of size 1000 kept in memory
+MAX_CACHED_MOVES = 1000 * 30000 #30000 superbooks of size 1000 spilled to disk
+SUPERBOOK_CACHE_FILE = "/tmp/shelve"
 
-MAX_CACHED_MOVES = 1000 * 30000 #30000 superbooks of size 1000
+BOOK_WORKER_CNT = os.cpu_count() or 1 #processes for compute_books_parallel
+PARALLEL_DEPTH = 2 #plies below the starting positions where compute_books_parallel hands subtrees to the workers
 
 DISK_CACHE_THRESHOLD = 20 # * 1000000
-CACHE_STATS_THRESHOLD = 20 # * 1000000
+
+class CacheTier():
+    def __init__(self, max_moves):
+        self.max_moves = max_moves
+        self.moves = 0 #total size of the superbooks in the tier
+        self.clock = 0 #priority of the last entry evicted
+        self.heap = [] #(priority, seq, key), including stale entries
 
 class SuperbookCache():
+    #two tier cache of superbooks keyed by (zobrist, fullmove, n, player, optimism, version)
+    #where version is the content version of the superbook (see book_versions)
+    #superbooks are kept in memory up to MAX_MEMORY_CACHED_MOVES moves
+    #and the ones evicted from memory spill to a shelve file of up to MAX_CACHED_MOVES moves
+    #
+    #each tier evicts its lowest priority entry using a heap, where
+    #priority = tier clock + pos_cnt * hits / n and the clock is the priority
+    #of the last entry the tier evicted. entries that keep getting hits stay
+    #ahead of the clock and ones that stop age out (greedy dual size frequency)
+    #heap entries are replaced rather than updated and skipped when stale
+    def __init__(self, memory_moves=MAX_MEMORY_CACHED_MOVES, disk_moves=MAX_CACHED_MOVES, filename=SUPERBOOK_CACHE_FILE):
+        #flag "n" starts from an empty file whatever extension dbm gives it
+        self.shelf = shelve.open(filename, flag="n", protocol=pickle.HIGHEST_PROTOCOL)
+        self.memory = {} #key -> superbook
+        self.entries = {} #key -> {pos_cnt, hits, priority, seq, tier}
+        self.tiers = {"memory": CacheTier(memory_moves), "disk": CacheTier(disk_moves)}
+        self.position_keys = {} #fen -> (zobrist, fullmove)
+        self.seq = 0
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0 #memory -> disk
+        self.drops = 0 #evicted from disk
+    def key(self, fen, n, player, optimism=0, version=0):
+        if fen not in self.position_keys:
+            fields = fen.split()
+            fields[-2] = "0"
+            self.position_keys[fen] = (hash_fen(" ".join(fields)), int(fields[-1]))
+        #+ 0.0 so that -0.0 and 0 give the same shelf key
+        return self.position_keys[fen] + (n, player, optimism + 0.0, version)
+    def shelf_key(self, key):
+        return "%x %d %d %d %r %d" % key
+    def touch(self, key, entry):
+        tier = self.tiers[entry["tier"]]
+        entry["priority"] = tier.clock + entry["pos_cnt"] * entry["hits"] / key[2]
+        entry["seq"] = self.seq
+        self.seq += 1
+        heapq.heappush(tier.heap, (entry["priority"], entry["seq"], key))
+        if len(tier.heap) > 4 * len(self.entries) + 1000:
+            #drop the stale heap entries
+            tier.heap = [x for x in tier.heap if self.is_current(x, entry["tier"])]
+            heapq.heapify(tier.heap)
+    def is_current(self, heap_entry, tier_name):
+        priority, seq, key = heap_entry
+        entry = self.entries.get(key)
+        return entry is not None and entry["tier"] == tier_name and entry["seq"] == seq
+    def pop_lowest(self, tier_name):
+        tier = self.tiers[tier_name]
+        while True:
+            heap_entry = heapq.heappop(tier.heap)
+            if self.is_current(heap_entry, tier_name):
+                tier.clock = heap_entry[0]
+                return heap_entry[2]
+    def load(self, fen, n, player, optimism=0, version=0):
+        #the cached superbook or None
+        key = self.key(fen, n, player, optimism, version)
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        if entry["tier"] == "memory":
+            self.hits += 1
+            superbook = self.memory[key]
+        else:
+            #move back into memory
+            self.disk_hits += 1
+            superbook = self.shelf.pop(self.shelf_key(key))
+            self.tiers["disk"].moves -= n
+            self.tiers["memory"].moves += n
+            self.memory[key] = superbook
+            entry["tier"] = "memory"
+        entry["hits"] += 1
+        self.touch(key, entry)
+        self.shrink()
+        return superbook
+    def save(self, fen, n, player, superbook, pos_cnt, optimism=0, version=0):
+        key = self.key(fen, n, player, optimism, version)
+        if key in self.entries:
+            self.remove(key)
+        entry = {"pos_cnt": pos_cnt, "hits": 1, "tier": "memory"}
+        self.entries[key] = entry
+        self.memory[key] = superbook
+        self.tiers["memory"].moves += n
+        self.touch(key, entry)
+        self.shrink()
+    def remove(self, key):
+        entry = self.entries.pop(key)
+        self.tiers[entry["tier"]].moves -= key[2]
+        if entry["tier"] == "memory":
+            del self.memory[key]
+        else:
+            del self.shelf[self.shelf_key(key)]
+    def shrink(self):
+        memory = self.tiers["memory"]
+        while memory.moves > memory.max_moves:
+            key = self.pop_lowest("memory")
+            self.evictions += 1
+            entry = self.entries[key]
+            self.shelf[self.shelf_key(key)] = self.memory.pop(key)
+            entry["tier"] = "disk"
+            memory.moves -= key[2]
+            self.tiers["disk"].moves += key[2]
+            self.touch(key, entry)
+        disk = self.tiers["disk"]
+        while disk.moves > disk.max_moves:
+            self.drops += 1
+            self.remove(self.pop_lowest("disk"))
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "drops": self.drops,
+            "memory_moves": self.tiers["memory"].moves,
+            "disk_moves": self.tiers["disk"].moves
+        }
+
+class SavedSuperbooks():
+    #superbook_cache of the compute_books_parallel workers: nothing is cached in the worker,
+    #the superbooks compute_books saves are sent back to the parent's superbook_cache
+    #so they're kept across rounds like the ones compute_books saves in the parent
     def __init__(self):
-        self.cnt = 0
-        filename = "/tmp/shelve"
-        if os.path.exists(filename):
-            os.remove(filename)
-        self.shelf = shelve.open(filename)
-    def save_cache(self, fen, n, player, superbook):
-        if str((fen, n, player)) not in self.shelf:
-            self.cnt += 1
-        self.shelf[str((fen, n, player))] = superbook
-    def load_cache(self, fen, n, player):
-        return self.shelf[str((fen, n, player))]
-    def evict(self, fen, n, player):
-        if str((fen, n, player)) in self.shelf:
-            self.cnt -= 1
-        del self.shelf[str((fen, n, player))]
-    def in_cache(self, fen, n, player):
-        return str((fen, n, player)) in self.shelf
-
-disk_cache = SuperbookCache()
+        self.saved = [] #(fen, n, player, exported superbook, pos_cnt, optimism, version)
+    def load(self, fen, n, player, optimism=0, version=0):
+        return None
+    def save(self, fen, n, player, superbook, pos_cnt, optimism=0, version=0):
+        self.saved.append((fen, n, player, export_superbook(superbook), pos_cnt, optimism, version))
+
+superbook_cache = SuperbookCache()
+
+#(fen, n, player, optimism) -> superbook computed by a worker, see compute_books_parallel
+precomputed_superbooks = {}
+
+#fen -> number of times the evaluation of the (leaf) position or the probabilities of
+#its moves have changed, see mark_dirty
+position_changes = {}
 
 
 LEAF_COUNT = 0
@@ -155,50 +301,25 @@ PROBABILITY_MULTIPLIERS = {
     #('r1bq1rk1/pp2nppp/2n1p3/2ppP3/3P2Q1/P1PB4/2P2PPP/R1B1K1NR w KQ - - 9', 'g1f3'): 3,
 }
 
-def compute_p1_book(pos, n, optimism=0):
-    #return superbook of size N moves that will give the greatest advantage
-    if False:
-        print()
-        print(pos.val)
-        print()
-        print(chess.Board(pos.val))
-        print()
-
-    #TODO: replace all this with a cache singleton
+def leaf_superbook(pos, n, player, optimism=0):
+    #superbook for a position with no children, from its evaluation
     global LEAF_COUNT
+    LEAF_COUNT += 1
+    if LEAF_COUNT % 1000 == 0:
+        print(f"Leaf count: {LEAF_COUNT}")
+    if player == 1:
+        ev = pos.get_ev(optimism)
+    else:
+        ev = 1 - pos.get_ev(-1 * optimism)
+    if INCLUDE_PLACEHOLDERS:
+        # return SuperBook.placeholder(pos, ev, n)
+        return PlaceholderSuperBook(pos, ev, n)
+    else:
+        return SuperBook(pos, ev)
 
-
-    if pos.total_cnt > DISK_CACHE_THRESHOLD:
-        if disk_cache.in_cache(pos.val, n, 1):
-            return disk_cache.load_cache(pos.val, n, 1)
-
-    # if pos.total_cnt > CACHE_STATS_THRESHOLD:
-    #     #update cache stats
-    #     P1_CACHE_STATS.setdefault((pos.val, n),{})
-    #     info = P1_CACHE_STATS[(pos.val,n)]
-    #     info["cnt"] = info.get("cnt",0) + 1 #number of times encountered
-    #     info["last_leaf"] = LEAF_COUNT
-    #     info["db_freq"] = pos.total_cnt
-
-    # if (pos.val, n) in P1_CACHE:
-    #     return P1_CACHE[(pos.val,n)]
-
-    if pos.is_leaf():
-        LEAF_COUNT += 1
-        if LEAF_COUNT % 1000 == 0:
-            print(f"Leaf count: {LEAF_COUNT}")
-        if INCLUDE_PLACEHOLDERS:
-            # return SuperBook.placeholder(pos, pos.get_ev(optimism), n)
-            return PlaceholderSuperBook(pos, pos.get_ev(optimism), n)
-        else:
-            return SuperBook(pos, pos.get_ev(optimism))
-
-    superbooks = {} #{node: SuperBook}
-
-    #step 1: compute book for each child node
-    for child in pos.children:
-        superbooks[child] = compute_p2_book(child, n, optimism = -1 * optimism)
-
+def combine_p1_books(pos, n, superbooks):
+    #superbook for a position where it's our turn
+    #from the superbooks of its children, which are the opponent's turn
     #now the real computation
     starting_ev = sum([superbooks[child].get_total_ev(0) * pos.probs[child] for child in pos.children])
 
@@ -349,116 +470,277 @@ def compute_p1_book(pos, n, optimism=0):
     #         choose_book = choose_superbook.get_book(k+1)
     #         superbook.add_book(k+1, choose_book, choose_ev)
 
-    # if pos.total_cnt > CACHE_THRESHOLD:
-    #     print(pos.val, pos.total_cnt)
-    #     P1_CACHE[(pos.val,n)] = superbook
-    # elif pos.total_cnt > COUNTER_THRESHOLD:
-    #     P1_COUNTER[(pos.val,n)] = P1_COUNTER.setdefault((pos.val,n),0) + 1
-    #     if P1_COUNTER[(pos.val,n)] * pos.total_cnt >= COUNTER_CACHE_THRESHOLD:
-    #         print(pos.val, pos.total_cnt, P1_COUNTER[(pos.val,n)])
-    #         P1_CACHE[(pos.val,n)] = superbook
-
-
-    if pos.total_cnt >= DISK_CACHE_THRESHOLD:
-        disk_cache.save_cache(pos.val, n, 1, superbook)
-
-    if pos.total_cnt >= CACHE_STATS_THRESHOLD:
-        info = CACHE_STATS.setdefault((pos.val, n, 1),{})
-        info["cnt"] = info.get("cnt",0) + 1
-        info["last_leaf"] = LEAF_COUNT
-        info["pos_cnt"] = pos.total_cnt
-
-
-    if disk_cache.cnt * n > MAX_CACHED_MOVES:
-        #purge 10% of the cache
-        cache_score = lambda x: CACHE_STATS[x]["pos_cnt"] * (1 / (math.log(2 + LEAF_COUNT - CACHE_STATS[x]["last_leaf"]))) * (CACHE_STATS[x]["cnt"] / (LEAF_COUNT+1))
-        cache_keys = [eval(x) for x in disk_cache.shelf.keys()]
-        values = sorted(cache_keys, key = cache_score, reverse=True)
-        to_evict = values[round(0.9 * disk_cache.cnt):]
-        for (fen, n, player) in to_evict:
-            disk_cache.evict(fen, n, player)
-
-    # if pos.total_cnt > CACHE_STATS_THRESHOLD:
-    #     P1_CACHE[(pos.val,n)] = superbook
-
-
-    # if len(P1_CACHE) * n > MAX_CACHED_MOVES:
-    #     #purge 10% of the cache
-    #     cache_score = lambda x: P1_CACHE_STATS[x]["db_freq"] * (1 / (math.log(2 + LEAF_COUNT - P1_CACHE_STATS[x]["last_leaf"]))) * (P1_CACHE_STATS[x]["cnt"] / (LEAF_COUNT+1))
-    #     values = sorted(P1_CACHE.keys(), key = cache_score, reverse = True)
-    #     values = values[:round(0.9 * len(P1_CACHE))]
-    #     P1_CACHE = {x:P1_CACHE[x] for x in values}
-
     return superbook
 
+def compute_p1_book(pos, n, optimism=0):
+    #return superbook of size N moves that will give the greatest advantage
+    return compute_book(pos, n, 1, optimism)
+
 def compute_p2_book(pos, n, optimism=0):
     #compute the book for a node which is the opponent's turn
+    return compute_book(pos, n, 2, optimism)
+
+def mark_dirty(fen):
+    #the evaluation of the leaf fen or the probabilities of the moves from fen changed
+    #this changes the versions of the superbooks above fen, so compute_books
+    #recomputes those and keeps using the cached superbooks of everything else
+    position_changes[fen] = position_changes.get(fen, 0) + 1
+
+def book_versions(roots):
+    #state -> content version for the (node, player, optimism) states below the roots
+    #the version of a state is a hash of its position's change count and the versions
+    #of its children, so it changes exactly when something below it was marked dirty
+    versions = {}
+    stack = [(root, False) for root in roots]
+    while stack:
+        state, expanded = stack.pop()
+        node, player, optimism = state
+        if expanded:
+            child_versions = tuple(versions[(child, 3 - player, -1 * optimism)] for child in node.children)
+            versions[state] = hash((node.val, position_changes.get(node.val, 0), child_versions))
+            continue
+        if state in versions:
+            continue
+        versions[state] = None #in progress
+        stack.append((state, True))
+        for child in node.children:
+            child_state = (child, 3 - player, -1 * optimism)
+            if child_state not in versions:
+                stack.append((child_state, False))
+    return versions
+
+def cached_superbook(pos, n, player, optimism=0, version=0):
+    #superbook for pos from a parallel worker or the superbook cache, or None
+    superbook = precomputed_superbooks.get((pos.val, n, player, optimism))
+    if superbook is None and pos.total_cnt >= DISK_CACHE_THRESHOLD:
+        superbook = superbook_cache.load(pos.val, n, player, optimism, version)
+    return superbook
 
-    global LEAF_COUNT
-    global P2_CACHE
-
-    if pos.total_cnt >= DISK_CACHE_THRESHOLD:
-        if disk_cache.in_cache(pos.val, n, 2):
-            return disk_cache.load_cache(pos.val, n, 2)
-
-    # if pos.total_cnt > CACHE_STATS_THRESHOLD:
-    #     #update cache stats
-    #     P2_CACHE_STATS.setdefault((pos.val, n),{})
-    #     info = P2_CACHE_STATS[(pos.val,n)]
-    #     info["cnt"] = info.get("cnt",0) + 1 #number of times encountered
-    #     info["last_leaf"] = LEAF_COUNT
-    #     info["db_freq"] = pos.total_cnt
-
-    # if (pos.val, n) in P2_CACHE:
-    #     return P2_CACHE[(pos.val,n)]
-
-    if pos.is_leaf():
-        LEAF_COUNT += 1
-        if LEAF_COUNT % 1000 == 0:
-            print(f"Leaf count: {LEAF_COUNT}")
-        if INCLUDE_PLACEHOLDERS:
-            # return SuperBook.placeholder(pos, 1 - pos.get_ev(-1 * optimism), n)
-            return PlaceholderSuperBook(pos, 1 - pos.get_ev(-1 * optimism), n)
+def compute_books(roots, n):
+    #superbooks for each (pos, player, optimism) in roots, where player 1 picks
+    #the moves to learn (combine_p1_books) and player 2 plays randomly by the
+    #move probabilities (aggregate_random_books)
+    #
+    #pseudo fens merge transpositions so the positions below the roots form a DAG
+    #of (node, player, optimism) states. each state's superbook is computed once,
+    #after its children's, and is dropped once all of its parents have used it,
+    #so at most the frontier of the states in progress is held in memory.
+    #states reachable from several roots are shared between them.
+    #cached superbooks are looked up by content version, so after mark_dirty
+    #only the states above the changed positions are computed again
+    for pos, player, optimism in roots:
+        if player not in (1, 2):
+            raise Exception(f"unknown player: {player}")
+
+    roots = [(pos, player, optimism) for pos, player, optimism in roots]
+    versions = book_versions(roots)
+    parent_cnts = {root: 1 for root in roots} #state -> parents that haven't used its superbook yet, roots are never dropped
+    superbooks = {} #state -> superbook, for states done with parents still to do
+    order = [] #states to compute, children before parents
+    visited = set()
+    stack = [(root, False) for root in reversed(roots)]
+    while stack:
+        state, expanded = stack.pop()
+        if expanded:
+            order.append(state)
+            continue
+        if state in visited:
+            continue
+        visited.add(state)
+        node, player, optimism = state
+        superbook = cached_superbook(node, n, player, optimism, versions[state])
+        if superbook is not None:
+            superbooks[state] = superbook
+            continue
+        stack.append((state, True))
+        for child in node.children:
+            child_state = (child, 3 - player, -1 * optimism)
+            parent_cnts[child_state] = parent_cnts.get(child_state, 0) + 1
+            if child_state not in visited:
+                stack.append((child_state, False))
+
+    for state in order:
+        node, player, optimism = state
+        if node.is_leaf():
+            superbook = leaf_superbook(node, n, player, optimism)
         else:
-            return SuperBook(pos, 1 - pos.get_ev(-1 * optimism))
-
-    superbooks = {}
-    for child in pos.children:
-        superbooks[child] = compute_p1_book(child, n, optimism = -1 * optimism)
-
-
-    superbook = aggregate_random_books(n, pos.children, pos.probs, superbooks)
-
-    # if pos.total_cnt > CACHE_THRESHOLD:
-    #     print(pos.val, pos.total_cnt)
-    #     P2_CACHE[(pos.val,n)] = superbook
-    # elif pos.total_cnt > COUNTER_THRESHOLD:
-    #     P2_COUNTER[(pos.val,n)] = P2_COUNTER.setdefault((pos.val,n),0) + 1
-    #     if P2_COUNTER[(pos.val,n)] * pos.total_cnt >= COUNTER_CACHE_THRESHOLD:
-    #         print(pos.val, pos.total_cnt, P2_COUNTER[(pos.val,n)])
-    #         P2_CACHE[(pos.val,n)] = superbook
-
-
-    if pos.total_cnt >= DISK_CACHE_THRESHOLD:
-        disk_cache.save_cache(pos.val, n, 2, superbook)
-
-    if pos.total_cnt >= CACHE_STATS_THRESHOLD:
-        info = CACHE_STATS.setdefault((pos.val, n, 2),{})
-        info["cnt"] = info.get("cnt",0) + 1
-        info["last_leaf"] = LEAF_COUNT
-        info["pos_cnt"] = pos.total_cnt
-
-    # if pos.total_cnt > CACHE_STATS_THRESHOLD:
-    #     P2_CACHE[(pos.val,n)] = superbook
+            child_states = [(child, 3 - player, -1 * optimism) for child in node.children]
+            child_superbooks = {child_state[0]: superbooks[child_state] for child_state in child_states}
+            if player == 1:
+                superbook = combine_p1_books(node, n, child_superbooks)
+            else:
+                superbook = aggregate_random_books(n, node.children, node.probs, child_superbooks)
+            if node.total_cnt >= DISK_CACHE_THRESHOLD:
+                superbook_cache.save(node.val, n, player, superbook, node.total_cnt, optimism, versions[state])
+            for child_state in child_states:
+                parent_cnts[child_state] -= 1
+                if parent_cnts[child_state] == 0:
+                    del superbooks[child_state]
+        superbooks[state] = superbook
+    return [superbooks[root] for root in roots]
+
+def compute_book(pos, n, player, optimism=0):
+    return compute_books([(pos, player, optimism)], n)[0]
+
+def init_book_worker(nodes):
+    #each worker gets its own engine, started if it needs a search that isn't in the store
+    #the game tree is shared with the parent
+    global BOOK_NODES, EVALUATOR
+    BOOK_NODES = nodes
+    EVALUATOR = Evaluator(engine_cnt=1)
+
+def compute_book_task(task):
+    #worker for compute_books_parallel
+    #inputs: [((fen, player, optimism), exported superbook)] for the states below the task
+    #that were computed somewhere else
+    #returns the superbooks the task saved to superbook_cache along with its result
+    global LEAF_COUNT, superbook_cache
+    fen, n, player, optimism, inputs = task
+    superbook_cache = SavedSuperbooks()
+    for (input_fen, input_player, input_optimism), exported in inputs:
+        precomputed_superbooks[(input_fen, n, input_player, input_optimism)] = import_superbook(exported)
+    leaf_cnt = LEAF_COUNT
+    try:
+        superbook = compute_book(BOOK_NODES[fen], n, player, optimism)
+    finally:
+        precomputed_superbooks.clear()
+    EVALUATOR.save_evals()
+    return (fen, n, player, optimism), export_superbook(superbook), superbook_cache.saved, LEAF_COUNT - leaf_cnt
 
-    # if len(P2_CACHE) * n > MAX_CACHED_MOVES:
-    #     #purge 10% of the cache
-    #     cache_score = lambda x: P2_CACHE_STATS[x]["db_freq"] * (1 / (math.log(2 + LEAF_COUNT - P2_CACHE_STATS[x]["last_leaf"]))) * (P2_CACHE_STATS[x]["cnt"] / (LEAF_COUNT+1))
-    #     values = sorted(P2_CACHE.keys(), key = cache_score, reverse = True)
-    #     values = values[:round(0.9 * len(P2_CACHE))]
-    #     P2_CACHE = {x:P2_CACHE[x] for x in values}
+def compute_books_parallel(roots, n, nodes, worker_cnt=BOOK_WORKER_CNT, depth=PARALLEL_DEPTH):
+    #same superbooks as compute_books(roots, n)
+    #the positions depth plies below the roots are computed across a pool of worker processes
+    #and then the levels above them are computed here, from the workers' superbooks
+    #
+    #transpositions join the subtrees below those positions, so the states reachable
+    #from more than one of them are split off as tasks of their own, computed once
+    #before the tasks above them. shared leaves are computed here instead of as tasks.
+    #each task gets the superbooks of the split off and cached states right below it
+    #and the superbooks the tasks save go to superbook_cache, so after mark_dirty
+    #only the states above the changed positions are computed again, as in compute_books
+    global LEAF_COUNT
 
-    return superbook
+    versions = book_versions(roots)
+
+    #(fen, player, optimism) -> (node, player, optimism) for the positions depth plies below the roots
+    #that aren't below a cached superbook
+    frontier = {(pos.val, player, optimism): (pos, player, optimism) for pos, player, optimism in roots}
+    for _ in range(depth):
+        children = {}
+        for state in frontier.values():
+            node, player, optimism = state
+            if cached_superbook(node, n, player, optimism, versions[state]) is not None:
+                continue
+            for child in node.children:
+                children[(child.val, 3 - player, -1 * optimism)] = (child, 3 - player, -1 * optimism)
+        frontier = children
+    frontier = set(frontier.values())
+
+    #the states below the frontier that aren't cached, children before parents
+    cached = {} #state -> cached superbook, for the cached states right below the ones to compute
+    parents = {} #state -> parent states to compute
+    order = []
+    visited = set()
+    stack = [(state, False) for state in frontier]
+    while stack:
+        state, expanded = stack.pop()
+        if expanded:
+            order.append(state)
+            continue
+        if state in visited:
+            continue
+        visited.add(state)
+        node, player, optimism = state
+        superbook = cached_superbook(node, n, player, optimism, versions[state])
+        if superbook is not None:
+            cached[state] = superbook
+            continue
+        stack.append((state, True))
+        for child in node.children:
+            child_state = (child, 3 - player, -1 * optimism)
+            parents.setdefault(child_state, []).append(state)
+            if child_state not in visited:
+                stack.append((child_state, False))
+
+    #each state belongs to the task of its parents, or starts a task of its own
+    #if it's on the frontier or its parents are in different tasks
+    owners = {}
+    for state in reversed(order):
+        parent_owners = {owners[parent] for parent in parents.get(state, [])}
+        owners[state] = parent_owners.pop() if state not in frontier and len(parent_owners) == 1 else state
+
+    def task_key(state):
+        node, player, optimism = state
+        return (node.val, n, player, optimism)
+
+    inputs = {} #task -> {state: superbook} from the cache or computed here
+    waiting = {} #task -> tasks it needs the superbooks of
+    for state in order:
+        if owners[state] != state:
+            continue
+        node, player, optimism = state
+        if node.is_leaf():
+            precomputed_superbooks[task_key(state)] = leaf_superbook(node, n, player, optimism)
+        else:
+            inputs[state] = {}
+            waiting[state] = set()
+    for state in order:
+        task = owners[state]
+        if task not in inputs:
+            continue
+        node, player, optimism = state
+        for child in node.children:
+            child_state = (child, 3 - player, -1 * optimism)
+            if child_state in cached:
+                inputs[task][child_state] = cached[child_state]
+            elif owners[child_state] != task:
+                if child_state in waiting:
+                    waiting[task].add(child_state)
+                else:
+                    inputs[task][child_state] = precomputed_superbooks[task_key(child_state)]
+    dependents = {} #task -> tasks waiting on it
+    for task, deps in waiting.items():
+        for dep in deps:
+            dependents.setdefault(dep, []).append(task)
+
+    def task_args(task):
+        node, player, optimism = task
+        task_inputs = [((state[0].val, state[1], state[2]), export_superbook(superbook)) for state, superbook in inputs[task].items()]
+        return (node.val, n, player, optimism, task_inputs)
+
+    #fork so the workers share the game tree without copying or pickling it
+    try:
+        with multiprocessing.get_context("fork").Pool(worker_cnt, initializer=init_book_worker, initargs=(nodes,)) as pool:
+            results = queue.Queue()
+            def submit(task):
+                pool.apply_async(compute_book_task, (task_args(task),), callback=results.put, error_callback=results.put)
+            #largest subtrees first so they don't hold up the end of the run
+            for task in sorted(waiting, key=lambda x: x[0].total_cnt, reverse=True):
+                if not waiting[task]:
+                    submit(task)
+            states = {task_key(task): task for task in waiting}
+            for _ in range(len(waiting)):
+                result = results.get()
+                if isinstance(result, Exception):
+                    raise result
+                key, exported, saved, leaf_cnt = result
+                task = states[key]
+                superbook = import_superbook(exported)
+                precomputed_superbooks[key] = superbook
+                LEAF_COUNT += leaf_cnt
+                for fen, n, player, saved_exported, pos_cnt, optimism, version in saved:
+                    superbook_cache.save(fen, n, player, import_superbook(saved_exported), pos_cnt, optimism, version)
+                for parent_task in dependents.get(task, []):
+                    inputs[parent_task][task] = superbook
+                    waiting[parent_task].remove(task)
+                    if not waiting[parent_task]:
+                        submit(parent_task)
+        #the workers appended their evaluations to the store, read them here
+        #so the levels above the tasks and later runs don't search them again
+        EVALUATOR.refresh_evals()
+        return compute_books(roots, n)
+    finally:
+        precomputed_superbooks.clear()
 
 def aggregate_random_books(n, positions, probs, superbooks):
     #if we have a random probability of reaching various positions
@@ -470,30 +752,11 @@ def aggregate_random_books(n, positions, probs, superbooks):
     #initialize to all zeroes
     cnts = {p:0 for p in positions}
 
-    # if positions and int(positions[0].val.split()[-1]) <= 3:
-    #     print("printing aggs")
-    #     print([p.val for p in positions])
-
-    #0.5282897987306038
-    #0.0036 * math.log(x+1)
-    #debug_move = ('rnbqkb1r/pppppppp/5n2/8/3P4/8/PPP1PPPP/RNBQKBNR w KQkq - - 2', 'c2c4', 0.5375091772533165)
-    #0.5365791050653824
-
     # debug_move = ('rn1q1rk1/4bppp/p2pbn2/1p2p3/4P3/1NN1BP2/PPPQ2PP/2KR1B1R w - - - 11', 'move_9', 0.5163221026503005)
     debug_move = ('rn1q1rk1/4bppp/p2pbn2/1p2p3/4P3/1NN1BP2/PPPQ2PP/2KR1B1R w - - - 1111', 'move_9', 0.5163221026503005) #placeholder
-    #debug_child_pos = 'rnbqkb1r/pp1n1ppp/4p3/2ppP3/3P1P2/8/PPP1N1PP/R1BQKBNR b KQkq - - 6' #'rnbqkb1r/ppp2ppp/4pn2/3p2B1/3PP3/2N5/PPP2PPP/R2QKBNR b KQkq - - 4'
     debug_child_pos = 'r1bqkb1r/pp1n1ppp/2n1p3/2ppP3/3P1P2/5N2/PPP1N1PP/R1BQKB1R b KQkq - - 7'
 
     debug = False
-    # debug code
-    # if debug_move[0] in [p.val for p in positions]:
-    #     print("*******")
-    #     print("input")
-    #     print("*******")
-    #     debug = True
-    #     pos = [p for p in positions if p.val == "rnbqkb1r/pppppppp/5n2/8/3P4/8/PPP1PPPP/RNBQKBNR w KQkq - - 2"][0]
-    #     for x in superbooks[pos].new_marginal_moves:
-    #         print(x)
 
     #compute starting ev with no opening book
     starting_ev = sum([superbooks[p].get_total_ev(0) * probs[p] for p in positions])
@@ -501,13 +764,6 @@ def aggregate_random_books(n, positions, probs, superbooks):
     output_superbook = SuperBook(None, starting_ev)
     total_ev = starting_ev
 
-    # def get_options():
-    #     #list of positions with additional moves we haven't picked yet
-    #     return [p for p in positions if superbooks[p].get_size() > cnts[p]]
-
-    # print("aggregating")
-    # print([p.val for p in positions])
-
     if debug and (debug_child_pos in [p.val for p in positions]):
         print("printing sub superbook")
         debug_pos = [p for p in positions if p.val == debug_child_pos][0]
@@ -520,11 +776,16 @@ def aggregate_random_books(n, positions, probs, superbooks):
             print({x for x in add_moves  if x[:2] in add_pre and x[:2] not in drop_pre})
             print({x for x in drop_moves if x[:2] in drop_pre and x[:2] not in add_pre})
 
-
     moves_by_fen = {} #fen -> {move}
-    options = {x for x in positions if superbooks[x].get_size() > cnts[x]}
+    book_size = 0 #number of moves in moves_by_fen
     marginal_evs = {x: superbooks[x].get_marginal_ev(cnts[x]+1) * probs[x] for x in positions}
     est_marginal_evs = {x: superbooks[x].get_est_marginal_ev(cnts[x]+1) * probs[x] for x in positions}
+    #max heap by est_marginal_ev of the positions with additional moves we haven't picked yet
+    #ties go to the earlier position
+    options = [(-est_marginal_evs[x], j, x) for j, x in enumerate(positions) if superbooks[x].get_size() > cnts[x]]
+    heapq.heapify(options)
+    #positions that would stall the greedy algorithm, see the "zero marginal value" check
+    zero_cnt = sum(1 for p in positions if est_marginal_evs[p] == 0 and probs[p] != 0)
 
     def add(moves1, moves2, update=True, multi=False):
         #add the moves from moves2 to the current set of moves moves1
@@ -577,52 +838,37 @@ def aggregate_random_books(n, positions, probs, superbooks):
                             del moves1[fen]
         return added_moves, removed_moves
 
-    def apply_diff(moves1, add_moves, discard_moves, update=True):
-        output_add = {}
-        output_discard = {}
-
-        add1, remove1 = remove(moves1, discard_moves, update)
-        add2, remove2 = add(moves1, add_moves, update)
-
-        for m in add1:
-            output_add.setdefault(m[0],set())
-            output_add[m[0]].add(m)
-        for m in add2:
-            output_add.setdefault(m[0],set())
-            output_add[m[0]].add(m)
-
-        for m in remove1:
-            output_discard.setdefault(m[0],set())
-            output_discard[m[0]].add(m)
-        for m in remove2:
-            output_discard.setdefault(m[0],set())
-            output_discard[m[0]].add(m)
-
-        return output_add, output_discard
-
-    def combine_diffs(add_moves1, discard_moves1, add_moves2, discard_moves2):
-        output_add = {x: set(add_moves1[x]) for x in add_moves1}
-        output_discard = {x: set(discard_moves1[x]) for x in discard_moves1}
-
-        remove(output_discard, add_moves2, update=True)
-        remove(output_add, discard_moves2, update=True)
-        add(output_discard, discard_moves2, update=True)
-        add(output_add, add_moves2, update=True)
-        return output_add, output_discard
-
-    #apply_diff -- mutate, no-mutate
-    #combine_diffs -- (can do whatever)
+    def diff_size(fen, add_moves, discard_moves):
+        #change in the size of moves_by_fen from applying the diff for one fen
+        #counted the same way as the total over the fens: with every discard
+        #checked against the book before any of the adds
+        book_moves = moves_by_fen.get(fen)
+        if book_moves is None:
+            return len(add_moves)
+        added_moves = set()
+        removed_moves = {m for m in discard_moves if m in book_moves}
+        for move in add_moves:
+            if move not in book_moves:
+                added_moves.add(move)
+                if "move" not in move[1]:
+                    removed_moves.update(book_moves)
+        return len(added_moves) - len(removed_moves)
 
     #starting from an empty opening book
     #look through each of the positions and see how much value is gained from
     #memorizing one more move of their opening books
     #greedily choose the one that provides the best marginal ev and repeat N times
     for i in range(n):
-        #options = get_options()
         if len(options) == 0: break #no more moves to pick
 
+        #diff from the current book to the next one, as {fen: {move}}
+        #the diffs of a fen only depend on that fen's moves so the size change
+        #of the whole diff is kept as a sum over fens and updated for the fens
+        #that each increment touches
         next_book_remove = {} #fen -> {move}
         next_book_add = {} #fen -> {move}
+        next_book_sizes = {} #fen -> diff_size
+        next_book_size = 0 #sum of next_book_sizes
 
         while True:
             #Repeatedly consider learning one more move from the child position with the best marginal ev
@@ -633,11 +879,7 @@ def aggregate_random_books(n, positions, probs, superbooks):
             #compute the marginal value of memorizing one more move from that position
             #NOTE: "marginal_ev" values assume that the opening book moves are of
             #decreasing marginal value which won't necessarily hold, but hopefully isn't too far off
-
-            #get_marginal_ev = lambda x: superbooks[x].get_marginal_ev(cnts[x]+1) * probs[x]
-
-            best_pos = max(options, key = lambda x: est_marginal_evs[x])
-            # marginal_ev = get_marginal_ev(best_pos)
+            _, best_idx, best_pos = options[0]
             marginal_ev = marginal_evs[best_pos]
 
             #try incrementing the number of moves from best_pos by 1
@@ -653,16 +895,22 @@ def aggregate_random_books(n, positions, probs, superbooks):
                 fen = move[0]
                 discard_moves_dict.setdefault(fen,set()).add(move)
 
-            tmp_add, tmp_remove = combine_diffs(next_book_add, next_book_remove, add_moves_dict, discard_moves_dict)
-            tmp_add, tmp_remove = apply_diff(moves_by_fen, tmp_add, tmp_remove, update=False)
+            #combine with the diff so far, for just the fens this increment touches
+            fens = set(add_moves_dict).union(discard_moves_dict)
+            tmp_add = {fen: set(next_book_add[fen]) for fen in fens if fen in next_book_add}
+            tmp_remove = {fen: set(next_book_remove[fen]) for fen in fens if fen in next_book_remove}
+            remove(tmp_remove, add_moves_dict)
+            remove(tmp_add, discard_moves_dict)
+            add(tmp_remove, discard_moves_dict)
+            add(tmp_add, add_moves_dict)
+            tmp_sizes = {fen: diff_size(fen, tmp_add.get(fen, ()), tmp_remove.get(fen, ())) for fen in fens}
 
             #TODO: new_size computation not very accurate, think about how to fix it
-            new_size = sum(len(moves_by_fen[x]) for x in moves_by_fen)
-            new_size += sum(len(tmp_add[x]) for x in tmp_add)
-            new_size -= sum(len(tmp_remove[x]) for x in tmp_remove)
+            new_size = book_size + next_book_size
+            new_size += sum(tmp_sizes.values()) - sum(next_book_sizes.get(fen, 0) for fen in fens)
 
             if debug and (debug_child_pos in [p.val for p in positions]):
-                print(f"debug pos: {len(output_superbook.new_marginal_moves)}")
+                print(f"debug pos: {output_superbook.get_size()}")
                 print(best_pos.val, cnts[best_pos])
                 print([(p.val,cnts[p],marginal_evs[p], est_marginal_evs[p]) for p in cnts])
                 print(add_moves)
@@ -685,7 +933,17 @@ def aggregate_random_books(n, positions, probs, superbooks):
                 #break out of the loop, we can't add another move
                 break
             else:
-                next_book_add, next_book_remove = combine_diffs(next_book_add, next_book_remove, add_moves_dict, discard_moves_dict)
+                for fen in fens:
+                    if fen in tmp_add:
+                        next_book_add[fen] = tmp_add[fen]
+                    else:
+                        next_book_add.pop(fen, None)
+                    if fen in tmp_remove:
+                        next_book_remove[fen] = tmp_remove[fen]
+                    else:
+                        next_book_remove.pop(fen, None)
+                    next_book_size += tmp_sizes[fen] - next_book_sizes.get(fen, 0)
+                    next_book_sizes[fen] = tmp_sizes[fen]
 
                 if debug and (debug_move in add_moves or debug_move in discard_moves):
                     print("next book add/remove")
@@ -695,19 +953,20 @@ def aggregate_random_books(n, positions, probs, superbooks):
                     print("next book add/remove")
                     print(next_book_add, next_book_remove)
 
-
                 cnts[best_pos] = cnts[best_pos] + 1
                 if superbooks[best_pos].get_size() > cnts[best_pos]:
+                    zero_cnt -= est_marginal_evs[best_pos] == 0 and probs[best_pos] != 0
                     marginal_evs[best_pos] = superbooks[best_pos].get_marginal_ev(cnts[best_pos]+1) * probs[best_pos]
                     est_marginal_evs[best_pos] = superbooks[best_pos].get_est_marginal_ev(cnts[best_pos]+1) * probs[best_pos]
+                    zero_cnt += est_marginal_evs[best_pos] == 0 and probs[best_pos] != 0
+                    heapq.heapreplace(options, (-est_marginal_evs[best_pos], best_idx, best_pos))
                 else:
                     #remove best_pos from options
-                    options.discard(best_pos)
+                    heapq.heappop(options)
                 total_ev += marginal_ev
 
             #after incrementing a few times we're out of options then break out of the loop
             #and add to superbook
-            #options = get_options()
             if len(options) == 0:
                 break
 
@@ -718,24 +977,24 @@ def aggregate_random_books(n, positions, probs, superbooks):
             print(next_book_remove)
 
         #compute new moves to add and old moves to remove
-        tmp_add, tmp_remove = apply_diff(moves_by_fen, next_book_add, next_book_remove)
-
-        if sum(len(moves_by_fen[x]) for x in moves_by_fen) > i+1:
+        fens = set(next_book_add).union(next_book_remove)
+        book_size -= sum(len(moves_by_fen.get(fen, ())) for fen in fens)
+        _, remove_set = remove(moves_by_fen, next_book_remove)
+        add_set, removed_moves = add(moves_by_fen, next_book_add)
+        remove_set.update(removed_moves)
+        book_size += sum(len(moves_by_fen.get(fen, ())) for fen in fens)
+
+        if book_size > i+1:
             print("oversized superbook")
             print(i+1)
             print(moves_by_fen)
             print(next_book_add)
             print(next_book_remove)
-            print(tmp_add)
-            print(tmp_remove)
+            print(add_set)
+            print(remove_set)
             raise
 
-        add_set = set().union(*tmp_add.values())
-        remove_set = set().union(*tmp_remove.values())
-
         if debug and ((debug_move[0] in next_book_add and debug_move in next_book_add[debug_move[0]]) or (debug_move[0] in next_book_remove and debug_move in next_book_remove[debug_move[0]])):
-            print("tmp_add, tmp_remove")
-            print(tmp_add, tmp_remove)
             print("add/remove set")
             print(add_set, remove_set)
             print("positions")
@@ -747,20 +1006,9 @@ def aggregate_random_books(n, positions, probs, superbooks):
                 print(remove_set)
                 raise
 
-        # if len(add_set) == 0:
-        #     print("empty add!")
-        #     print([p.val for p in positions])
-        #     print(f"cnt: {len(output_superbook.new_marginal_moves)}")
-        #     print(add_set)
-        #     print(remove_set)
-        #     print(moves_by_fen)
-        #     print(next_book_add)
-        #     print(next_book_remove)
-        #     raise
-
         #TODO: what to do when we're aggregating from two subbooks
         #that each include the same move (transpositions)
-        if any([est_marginal_evs[p] == 0 and probs[p] != 0 for p in positions]):
+        if zero_cnt:
             print("zero marginal value")
             zero_pos = [p for p in positions if est_marginal_evs[p] == 0][0]
             print({p.val: (cnts[p],est_marginal_evs[p]) for p in positions})
@@ -778,10 +1026,9 @@ def aggregate_random_books(n, positions, probs, superbooks):
         print("output")
         print("*******")
         print([p.val for p in positions])
-        print(f"book size: {len(output_superbook.new_marginal_moves)}")
-        pos = [p for p in positions if (p.val == debug_move[0] or p.val == debug_child_pos)][0]
-        for i in range(len(output_superbook.new_marginal_moves)):
-            print(output_superbook.new_marginal_moves[i], output_superbook.marginal_evs[i])
+        print(f"book size: {output_superbook.get_size()}")
+        for i in range(output_superbook.get_size()):
+            print(output_superbook.get_marginal_moves(i+1), output_superbook.marginal_evs[i])
 
     return output_superbook
 
@@ -870,20 +1117,65 @@ class PlaceholderOpeningBook:
     def get_moves(self):
         return [self.get_move(i) for i in range(self.N)]
 
+class BookMoveIds():
+    #integer ids for the (fen, move) of the (fen, move, ev) book moves in superbooks, so a
+    #superbook holds arrays of ids and evs instead of tuples and never references the game graph
+    #real moves are numbered from 0 in the order first seen. Placeholder moves (fen, "move_i", ev)
+    #aren't stored: their id is -1 - (fen id * PLACEHOLDER_STRIDE + i). The evs are kept by the
+    #superbooks, so the table only grows with the positions and edges of the game graph
+    PLACEHOLDER_STRIDE = 2**20 #more than any n
+    def __init__(self):
+        self.fens = [] #fen id -> fen
+        self.fen_ids = {}
+        self.moves = [] #move id -> (fen id, move)
+        self.move_ids = {}
+    def fen_id(self, fen):
+        if fen not in self.fen_ids:
+            self.fen_ids[fen] = len(self.fens)
+            self.fens.append(fen)
+        return self.fen_ids[fen]
+    def placeholder_code(self, fen_id, i):
+        return -1 - (fen_id * self.PLACEHOLDER_STRIDE + i)
+    def encode(self, move):
+        #id of the (fen, move) of a (fen, move, ev) book move
+        fen_id = self.fen_id(move[0])
+        if move[1].startswith("move_"):
+            return self.placeholder_code(fen_id, int(move[1][5:]))
+        key = (fen_id, move[1])
+        move_id = self.move_ids.get(key)
+        if move_id is None:
+            move_id = self.move_ids[key] = len(self.moves)
+            self.moves.append(key)
+        return move_id
+    def decode(self, code, ev):
+        if code < 0:
+            fen_id, i = divmod(-1 - code, self.PLACEHOLDER_STRIDE)
+            return (self.fens[fen_id], f"move_{i}", ev)
+        fen_id, move = self.moves[code]
+        return (self.fens[fen_id], move, ev)
+
+BOOK_MOVES = BookMoveIds()
+
 class SuperBook:
     #For all i in 1,..N contains the opening book of <= i moves
     #along with the expected value for using that opening book
+    #book i adds the moves added[added_offsets[i-1]:added_offsets[i]] to book i-1
+    #and removes removed[removed_offsets[i-1]:removed_offsets[i]], as BOOK_MOVES ids
+    #with the ev of each move at the same index of added_evs/removed_evs
+    __slots__ = ["position", "starting_ev", "added", "added_evs", "added_offsets", "removed", "removed_evs", "removed_offsets", "total_evs", "marginal_evs", "est_marginal_evs"]
     def __init__(self, position, starting_ev):
         super()
-        self.position = position
+        self.position = None if position is None else BOOK_MOVES.fen_id(position.val) #fen id
         self.starting_ev = starting_ev
-        self.books = [] #TODO: remove
-        self.marginal_moves = {} #{k: [(added_moves, removed_moves)]} #TODO: remove
-        #once new_marginal_moves is working, replace self.marginal_moves
-        self.new_marginal_moves = [] #[(added_moves, removed_moves)]
-        self.total_evs = []
-        self.marginal_evs = []
-        self.est_marginal_evs = []
+        self.added = array.array("q")
+        self.added_evs = array.array("d")
+        self.added_offsets = array.array("q", [0])
+        self.removed = array.array("q")
+        self.removed_evs = array.array("d")
+        self.removed_offsets = array.array("q", [0])
+        self.total_evs = array.array("d")
+        self.marginal_evs = array.array("d")
+        self.est_marginal_evs = array.array("d")
     @staticmethod
     def placeholder(position, starting_ev, move_cnt):
         sb = SuperBook(position, starting_ev)
@@ -896,34 +1188,15 @@ class SuperBook:
             new_move = (position.val, f"move_{i}", total_ev)
             sb.add_marginal_moves(i+1, [new_move], [], total_ev)
         return sb
-    def add_book(self, i, book, total_ev):
-        #TODO: remove, concept of books replaces with marginal_moves
-        if len(self.books) != i-1:
-            print(i)
-            print(self)
-            raise
-        self.books.append(book) #OpeningBook(i, moves))
-        self.total_evs.append(total_ev)
-        if i == 1:
-            self.marginal_evs.append(total_ev - self.starting_ev)
-            self.est_marginal_evs.append(total_ev - self.starting_ev)
-            self.new_marginal_moves.append((book.get_moves(),[]))
-        else:
-            self.marginal_evs.append(self.total_evs[i-1] - self.total_evs[i-2])
-            self.est_marginal_evs.append(self.total_evs[i-1] - self.total_evs[i-2])
-            if isinstance(self.books[i-1],PlaceholderOpeningBook) and \
-               isinstance(self.books[i-2],PlaceholderOpeningBook) and \
-               self.books[i-1].position == self.books[i-2].position:
-                self.new_marginal_moves.append(([self.books[i-1].get_move(i-1)],[]))
-            else:
-                moves_new = self.books[i-1].get_moves()
-                moves_old = self.books[i-2].get_moves()
-                added_moves = set(moves_new).difference(set(moves_old))
-                removed_moves = set(moves_old).difference(set(moves_new))
-                self.new_marginal_moves.append((list(added_moves), list(removed_moves)))
-
+    def append_marginal_moves(self, added_moves, removed_moves):
+        self.added.extend(BOOK_MOVES.encode(move) for move in added_moves)
+        self.added_evs.extend(move[2] for move in added_moves)
+        self.added_offsets.append(len(self.added))
+        self.removed.extend(BOOK_MOVES.encode(move) for move in removed_moves)
+        self.removed_evs.extend(move[2] for move in removed_moves)
+        self.removed_offsets.append(len(self.removed))
     def add_marginal_moves(self, i, added_moves, removed_moves, total_ev):
-        self.new_marginal_moves.append((added_moves, removed_moves))
+        self.append_marginal_moves(added_moves, removed_moves)
         self.total_evs.append(total_ev)
 
         if i == 1:
@@ -940,24 +1213,12 @@ class SuperBook:
                 #added an abstract move -- use the real marginal_ev as the est_marginal_ev
                 self.est_marginal_evs.append(marginal_ev)
             else:
-                # if marginal_ev < 0.1 * self.marginal_evs[i-2] and marginal_ev < 10**-5:
-                #     print("major decline")
-                #     print(marginal_ev)
-                #     print(self.est_marginal_evs[i-2])
-                #     print(added_moves)
-                #     print(removed_moves)
-                #     print("printing superbook")
-                #     for i, (add_moves, drop_moves) in enumerate(self.new_marginal_moves):
-                #         add_pre = {m[:2] for m in add_moves}
-                #         drop_pre = {m[:2] for m in drop_moves}
-                #         print("ev")
-                #         print(self.marginal_evs[i])
-                #         print(self.est_marginal_evs[i])
-                #         print(add_pre)
-                #         print(drop_pre)
-                #     raise
                 self.est_marginal_evs.append(min(max(marginal_ev, self.est_marginal_evs[i-2] * 0.8), self.est_marginal_evs[i-2] * 1.2))
             self.marginal_evs.append(marginal_ev)
+    @property
+    def new_marginal_moves(self):
+        #[(added_moves, removed_moves)] for books 1..N
+        return list(self.get_all_marginal_moves())
     def get_total_ev(self, k):
         #EV of learning the book with (up to) k moves
         if k==0:
@@ -968,9 +1229,6 @@ class SuperBook:
         return self.marginal_evs[k-1]
     def get_est_marginal_ev(self, k):
         return self.est_marginal_evs[k-1]
-    def get_book(self, k):
-        #deprecated, remove after a while 2020-03-22
-        return self.books[k-1]
     def get_all_books(self):
         moves = set()
         for added_moves, removed_moves in self.get_all_marginal_moves():
@@ -980,28 +1238,30 @@ class SuperBook:
     def get_marginal_moves(self, k):
         #k is one-indexed
         #return diff between
-        #the moves in self.books[k-1]
-        #and the moves in self.books[k-2]
-        return self.new_marginal_moves[k-1]
+        #the moves in book k
+        #and the moves in book k-1
+        added_range = slice(self.added_offsets[k-1], self.added_offsets[k])
+        removed_range = slice(self.removed_offsets[k-1], self.removed_offsets[k])
+        added = [BOOK_MOVES.decode(code, ev) for code, ev in zip(self.added[added_range], self.added_evs[added_range])]
+        removed = [BOOK_MOVES.decode(code, ev) for code, ev in zip(self.removed[removed_range], self.removed_evs[removed_range])]
+        return added, removed
     def get_all_marginal_moves(self):
         for i in range(self.get_size()):
             yield self.get_marginal_moves(i+1)
     def get_size(self):
-        return len(self.new_marginal_moves)
+        return len(self.total_evs)
     def __str__(self):
-        return str(self.position) + '\n' +\
+        return str(None if self.position is None else BOOK_MOVES.fens[self.position]) + '\n' +\
                str(self.starting_ev) + '\n' +\
-               str(self.books) + '\n' +\
                str(self.total_evs) + '\n' +\
                str(self.marginal_evs)
 
 class PlaceholderSuperBook(SuperBook):
+    __slots__ = ["N"]
     def __init__(self, position, starting_ev, N):
-        self.position = position
+        self.position = BOOK_MOVES.fen_id(position.val)
         self.starting_ev = starting_ev
         self.N = N
-        self.new_marginal_moves = []
-        self.total_evs = []
     def get_total_ev(self, k):
         #EV of learning the book with (up to) k moves
         return self.starting_ev + OUT_OF_BOOK_PREP_VALUE(k)
@@ -1010,11 +1270,40 @@ class PlaceholderSuperBook(SuperBook):
     def get_est_marginal_ev(self, k):
         return OUT_OF_BOOK_PREP_VALUE(k) - OUT_OF_BOOK_PREP_VALUE(k-1)
     def get_marginal_moves(self, k):
-        marginal_move = (self.position.val, f"move_{k-1}", self.get_total_ev(k))
+        marginal_move = (BOOK_MOVES.fens[self.position], f"move_{k-1}", self.get_total_ev(k))
         return ([marginal_move],[])
     def get_size(self):
         return self.N
 
+def export_superbook(superbook):
+    #superbook with plain (fen, move, ev) tuples in place of the BOOK_MOVES ids,
+    #which only mean something in the process that made them
+    fen = None if superbook.position is None else BOOK_MOVES.fens[superbook.position]
+    if isinstance(superbook, PlaceholderSuperBook):
+        return (fen, superbook.starting_ev, superbook.N)
+    added = [BOOK_MOVES.decode(code, ev) for code, ev in zip(superbook.added, superbook.added_evs)]
+    removed = [BOOK_MOVES.decode(code, ev) for code, ev in zip(superbook.removed, superbook.removed_evs)]
+    return (fen, superbook.starting_ev, added, superbook.added_offsets, removed, superbook.removed_offsets,
+            superbook.total_evs, superbook.marginal_evs, superbook.est_marginal_evs)
+
+def import_superbook(exported):
+    #superbook from export_superbook, possibly made in another process
+    fen, starting_ev = exported[:2]
+    if len(exported) == 3:
+        superbook = PlaceholderSuperBook.__new__(PlaceholderSuperBook)
+        superbook.N = exported[2]
+    else:
+        superbook = SuperBook(None, starting_ev)
+        added, superbook.added_offsets, removed, superbook.removed_offsets = exported[2:6]
+        superbook.total_evs, superbook.marginal_evs, superbook.est_marginal_evs = exported[6:]
+        superbook.added = array.array("q", (BOOK_MOVES.encode(move) for move in added))
+        superbook.removed = array.array("q", (BOOK_MOVES.encode(move) for move in removed))
+        superbook.added_evs = array.array("d", (move[2] for move in added))
+        superbook.removed_evs = array.array("d", (move[2] for move in removed))
+    superbook.position = None if fen is None else BOOK_MOVES.fen_id(fen)
+    superbook.starting_ev = starting_ev
+    return superbook
+
 class GameNode:
     def __init__(self, val):
         super()
@@ -1061,14 +1350,21 @@ def move_history_to_pseudo_fen(move_history):
     fen = " ".join(fen)
     return fen
 
-def evaluate_pseudo_fen(fen, time, optimism = 0):
+def pseudo_fen_to_fen(fen):
     fen = fen.split()
     fen[-2] = "0"
-    fen = " ".join(fen)
+    return " ".join(fen)
+
+def evaluate_pseudo_fen(fen, time, optimism = 0):
+    fen = pseudo_fen_to_fen(fen)
 
     move, eval_ = EVALUATOR.evaluate_ev(fen, time)
     time = EVALUATOR.get_eval_time(fen) #time in millis
 
+    return move, eval_ + eval_error(time) * optimism
+
+def eval_error(time):
+    #expected error of an evaluation searched for time millis
     nodes = 1000 * 1000 * (time / 1000) #~1M nodes per second
     log2_nodes = math.log(nodes) / math.log(2)
 
@@ -1083,7 +1379,46 @@ def evaluate_pseudo_fen(fen, time, optimism = 0):
     #https://rjlipton.wordpress.com/2016/11/30/when-data-serves-turkey/
     error = 1/20000 * (3797 - elo) #on the order of .02
 
-    return move, eval_ + error * optimism
+    return error
+
+def pseudo_fen_eval_time(fen):
+    #time in millis that fen has been evaluated for, 0 if never
+    try:
+        return EVALUATOR.get_eval_time(pseudo_fen_to_fen(fen))
+    except KeyError:
+        return 0
+
+def prefetch_evaluations(fens, eval_time=EVAL_TIME, time_budget=PREFETCH_TIME_BUDGET):
+    #evaluate the pseudo fens that don't have an evaluation of at least eval_time yet,
+    #in batches across EVALUATOR's engines, so that evaluate_pseudo_fen(fen, eval_time)
+    #is a cache hit afterwards. Once time_budget seconds have passed no more batches
+    #are started and the rest are evaluated when they're first needed
+    fens = [pseudo_fen_to_fen(fen) for fen in dict.fromkeys(fens) if pseudo_fen_eval_time(fen) < eval_time]
+    print(f"prefetching {len(fens)} evaluations")
+    start_time = time.time()
+    batch_size = 4 * EVALUATOR.engine_cnt
+    for i in range(0, len(fens), batch_size):
+        if time_budget is not None and time.time() - start_time > time_budget:
+            print(f"prefetch time budget used up, {len(fens) - i} evaluations left")
+            break
+        EVALUATOR.evaluate_many(fens[i:i+batch_size], eval_time)
+    EVALUATOR.save_evals()
+
+def book_leaves(roots):
+    #fens of the leaves below the (pos, player, optimism) roots, which compute_books evaluates
+    leaves = []
+    visited = set()
+    stack = [pos for pos, player, optimism in roots]
+    while stack:
+        node = stack.pop()
+        if node in visited:
+            continue
+        visited.add(node)
+        if node.is_leaf():
+            leaves.append(node.val)
+        else:
+            stack.extend(node.children)
+    return leaves
 
 def print_pseudo_fen(fen):
     fen = fen.split()
@@ -1093,46 +1428,107 @@ def print_pseudo_fen(fen):
     print(chess.Board(fen))
 
 
+def parse_move_cnts(text):
+    #"{'e2e4': 10, 'd2d4': 5}" -> {'e2e4': 10, 'd2d4': 5} without eval()
+    return {move: int(cnt) for move, cnt in MOVE_CNT_RE.findall(text)}
+
+def parse_move_list(text):
+    #"['e2e4', 'e7e5']" -> ['e2e4', 'e7e5'] without eval()
+    return MOVE_LIST_RE.findall(text)
+
+def history_plus_move(move_history, move):
+    #str(eval(move_history) + [move])
+    if move_history == "[]":
+        return str([move])
+    return move_history[:-1] + ", " + repr(move) + "]"
+
+def parse_position_rows(rows):
+    #worker for generate_position_stats: parse INPUT_FILE rows and compute
+    #the fen after each played move. returns [(fen, move_cnts, move_history, children)]
+    #where children is {move: child fen}
+    out = []
+    for row in rows:
+        fen = row["fen"]
+        move_cnts = parse_move_cnts(row["move_cnts"])
+
+        #use this for quick tests
+        # if (sum(move_cnts[x] for x in move_cnts) < 10000): continue #MUST: REMOVE
+
+        if fen == "rnbqk2r/ppppppbp/5np1/8/2PPP3/5N2/PP3PPP/RNBQKB1R b KQkq - - 4": #guess this only comes up in pre-moves and is extremely successful there
+            move_cnts["f6e4"] = 100
+
+        move_history = str(parse_move_list(row["move_history"]))
+        children = {move: pseudo_fen_plus_move(fen, move) for move in move_cnts}
+        out.append((fen, move_cnts, move_history, children))
+    return out
+
+def move_probs(fen, move_cnts):
+    #{move: probability} for the moves played from fen
+    #weighted by PROBABILITY_MULTIPLIERS and PLAYER_STRENGTH
+    weights = {}
+    for move in move_cnts:
+        prob_mult = PROBABILITY_MULTIPLIERS.get((fen, move),1)
+        if PLAYER_STRENGTH:
+            weights[move] = (move_cnts[move] * prob_mult) ** PLAYER_STRENGTH
+        else:
+            weights[move] = (move_cnts[move] * prob_mult)
+    total_weight = sum(weights.values())
+    return {move: weights[move] / total_weight for move in weights}
+
+def set_probability_multipliers(multipliers, nodes, positions):
+    #replace PROBABILITY_MULTIPLIERS and update the move probabilities of the nodes
+    #whose multipliers changed, marking them dirty so the next compute_books
+    #only recomputes the superbooks above them
+    #NOTE: a GameGraph on disk keeps the probabilities it was built with
+    global PROBABILITY_MULTIPLIERS
+    changed = {fen for (fen, move), mult in set(PROBABILITY_MULTIPLIERS.items()) ^ set(multipliers.items())}
+    PROBABILITY_MULTIPLIERS = dict(multipliers)
+    for fen in changed:
+        if fen not in nodes:
+            continue
+        node = nodes[fen]
+        probs = move_probs(fen, positions[fen]["move_cnts"])
+        node.probs = {child: probs.get(move, 0) for child, move in node.moves.items()}
+        mark_dirty(fen)
+
 def generate_position_stats():
-    positions = {} #fen -> {fen, move_cnts:{move: cnt}, total_cnt}
+    positions = {} #fen -> {fen, move_cnts:{move: cnt}, move_history, children:{move: child fen}, best_move, probs, total_cnt}
 
     #position info
+    #rows are parsed and their children computed across STATS_WORKER_CNT processes
+    #and consumed here in file order. the child fen of each edge is stored in
+    #"children" so nothing downstream replays moves again
+    #the best moves are evaluated in bulk from a first pass over the fen column
+    #the pool is forked before that pass starts EVALUATOR's engines and their threads
     cnt = 0
-    with open(INPUT_FILE) as csvfile:
-        reader = csv.DictReader(csvfile)
-        move_history_to_fen_cache = {}
-        fen_plus_move_cache = {}
-        for row in reader:
-            cnt += 1
-            if (cnt % 1000 == 0): print(cnt)
-
-            move_cnts = eval(row["move_cnts"])
-
-            #use this for quick tests
-            # if (sum(move_cnts[x] for x in move_cnts) < 10000): continue #MUST: REMOVE
-
-            move_history = eval(row["move_history"])
+    with multiprocessing.Pool(STATS_WORKER_CNT) as pool, open(INPUT_FILE) as csvfile:
+        prefetch_evaluations(row["fen"] for row in csv.DictReader(csvfile))
 
-            fen = row["fen"]
-
-            if fen == "rnbqk2r/ppppppbp/5np1/8/2PPP3/5N2/PP3PPP/RNBQKB1R b KQkq - - 4": #guess this only comes up in pre-moves and is extremely successful there
-                move_cnts["f6e4"] = 100
-                print("hard coding f6e4 in this position: rnbqk2r/ppppppbp/5np1/8/2PPP3/5N2/PP3PPP/RNBQKB1R b KQkq - - 4")
-
-            positions[fen] = {"fen":fen, "move_cnts":move_cnts, "move_history": str(move_history)}
-            #set child info if not set
-            for move in move_cnts:
-                child_fen = pseudo_fen_plus_move(fen, move)
-                full_move_list = str(eval(row["move_history"]) + [move])
-                default = {"fen": child_fen, "move_cnts":{}, "move_history":full_move_list}
-                positions.setdefault(child_fen,default)
-
-            #set best move info if not set
-            best_move = evaluate_pseudo_fen(fen,EVAL_TIME)[0]
-            best_move_fen = pseudo_fen_plus_move(fen, best_move)
-            full_move_list = str(move_history + [best_move])
-            default = {"fen": best_move_fen, "move_cnts":{}, "move_history":full_move_list}
-            positions.setdefault(best_move_fen, default)
+        csvfile.seek(0)
+        reader = csv.DictReader(csvfile)
+        chunks = iter(lambda: list(itertools.islice(reader, STATS_CHUNK_ROWS)), [])
+        for rows in pool.imap(parse_position_rows, chunks):
+            for fen, move_cnts, move_history, children in rows:
+                cnt += 1
+                if (cnt % 1000 == 0): print(cnt)
+
+                if fen == "rnbqk2r/ppppppbp/5np1/8/2PPP3/5N2/PP3PPP/RNBQKB1R b KQkq - - 4":
+                    print("hard coding f6e4 in this position: rnbqk2r/ppppppbp/5np1/8/2PPP3/5N2/PP3PPP/RNBQKB1R b KQkq - - 4")
+
+                positions[fen] = {"fen":fen, "move_cnts":move_cnts, "move_history": move_history, "children": children}
+                #set child info if not set
+                for move, child_fen in children.items():
+                    default = {"fen": child_fen, "move_cnts":{}, "move_history":history_plus_move(move_history, move), "children": {}}
+                    positions.setdefault(child_fen,default)
+
+                #set best move info if not set
+                best_move = evaluate_pseudo_fen(fen,EVAL_TIME)[0]
+                if best_move not in children:
+                    children[best_move] = pseudo_fen_plus_move(fen, best_move)
+                positions[fen]["best_move"] = best_move
+                best_move_fen = children[best_move]
+                default = {"fen": best_move_fen, "move_cnts":{}, "move_history":history_plus_move(move_history, best_move), "children": {}}
+                positions.setdefault(best_move_fen, default)
 
 
     #warn if any positions have >0 and <20 moves --
@@ -1152,35 +1548,16 @@ def generate_position_stats():
         info.setdefault("probs",{})
         fen = info["fen"]
 
-        #set counts
-        total_cnt = 0
-        total_weight = 0
-
-        for move in info["move_cnts"]:
-            prob_mult = PROBABILITY_MULTIPLIERS.get((fen, move),1)
-            if PLAYER_STRENGTH:
-                total_weight += (info["move_cnts"][move] * prob_mult) ** PLAYER_STRENGTH
-            else:
-                total_weight += (info["move_cnts"][move] * prob_mult)
-            total_cnt += info["move_cnts"][move]
-
         #set probs
-        for move in info["move_cnts"]:
-            child_fen = pseudo_fen_plus_move(fen, move)
-            prob_mult = PROBABILITY_MULTIPLIERS.get((fen, move),1)
-            if PLAYER_STRENGTH:
-                weight = (info["move_cnts"][move] * prob_mult) ** PLAYER_STRENGTH
-            else:
-                weight = (info["move_cnts"][move] * prob_mult)
-            info["probs"][move] = weight / total_weight
+        info["probs"].update(move_probs(fen, info["move_cnts"]))
 
         #set total cnt
+        total_cnt = sum(info["move_cnts"].values())
         info["total_cnt"] = total_cnt
 
         #add best_move as an edge with weight 0
         if total_cnt > 0: #skip this step for leaf nodes
-            best_move = evaluate_pseudo_fen(fen,EVAL_TIME)[0]
-            info["probs"].setdefault(best_move,0)
+            info["probs"].setdefault(info["best_move"],0)
     return positions
 
 def generate_game_tree(positions):
@@ -1200,9 +1577,7 @@ def generate_game_tree(positions):
 
         #set children, probs, moves
         for move in positions[fen]["probs"]:
-            child_fen = pseudo_fen_plus_move(fen, move)
-            full_move_list = str(eval(positions[fen]["move_history"]) + [move])
-            child_node = nodes[child_fen]
+            child_node = nodes[positions[fen]["children"][move]]
 
             children.append(child_node)
             moves[child_node] = move
@@ -1212,6 +1587,18 @@ def generate_game_tree(positions):
 
     return nodes
 
+def load_game_graph():
+    #game tree from the compiled graph, building it first if INPUT_FILE
+    #or the settings the probabilities depend on have changed
+    #returns (nodes, positions) in place of generate_game_tree and generate_position_stats
+    config = repr((PLAYER_STRENGTH, sorted(PROBABILITY_MULTIPLIERS.items()), EVAL_TIME))
+    if not GameGraph.is_current(GAME_GRAPH_DIR, INPUT_FILE, config):
+        positions = generate_position_stats()
+        nodes = generate_game_tree(positions)
+        build_game_graph(nodes, positions, GAME_GRAPH_DIR, INPUT_FILE, config)
+    graph = GameGraph(GAME_GRAPH_DIR, get_ev=lambda node, optimism: evaluate_pseudo_fen(node.val, EVAL_TIME, optimism)[1])
+    return graph, GraphPositions(graph)
+
 def print_book(superbook, name, positions):
     print(superbook.get_total_ev(0))
     #note: the best book might not be the one with the most moves!
@@ -1302,33 +1689,71 @@ def get_book_info(book_hash, start_node, start_node_prob, move_cnt):
 
         return leaves, errors
 
-def generate_book(starting_fen, move_cnt, side, nodes, positions):
-    #reset the global caches
-    global CACHE_STATS
-
-    CACHE_STATS = {}
-
-    start_node = nodes[starting_fen]
-    print("generating book")
-    if side == "white":
-        superbook = compute_p1_book(start_node, move_cnt, 0)
-    elif side == "black":
-        superbook = compute_p2_book(start_node, move_cnt, 0)
-    else:
-        raise
-    print_book(superbook, side, positions)
+SIDE_PLAYERS = {"white": 1, "black": 2}
 
-    CACHE_STATS = {}
-
-    #Refine evaluations:
-    #the above evaluations are 1 second per move, which gives some inaccuracies
-    #and the opening book will suggest some moves that look good based on 1 second
-    #of evaluation but wouldn't after a longer evaluation. So after computing the opening book,
-    #rerun the most common positions with a longer eval (10 seconds)
-    #and then generate the opening book again. Can iterate on this if necessary
-    print("refining evaluations")
-
-    starting_fen = move_history_to_pseudo_fen(str(starting_history))
+def generate_books(configs, nodes, positions, worker_cnt=BOOK_WORKER_CNT, refine_rounds=1, refine_time_budget=REFINE_TIME_BUDGET, refine_engine_budget=REFINE_ENGINE_BUDGET):
+    #generate several books together
+    #configs: [{"starting_fen", "move_cnt", "side", "optimism" (default 0), "name" (optional)}]
+    #
+    #the configs with the same move_cnt are computed in one compute_books pass, so the
+    #positions they have in common are only done once. The passes for different
+    #move_cnts share the game graph, the leaf evaluations and the superbook cache
+    #(the first k books of a superbook depend on its n, so they can't share superbooks)
+    #
+    #each round computes the books and then refines the evaluations of their most
+    #likely leaves within the refine budgets (see refine_evaluations). Later rounds only
+    #recompute the superbooks above the refined leaves, print how much each book's
+    #total ev moved, and stop early once refining doesn't change any evaluations
+    #returns the superbooks of the last round in the order of configs
+    roots = []
+    for config in configs:
+        if config["side"] not in SIDE_PLAYERS:
+            raise Exception(f"unknown side: {config['side']}")
+        roots.append((nodes[config["starting_fen"]], SIDE_PLAYERS[config["side"]], config.get("optimism", 0)))
+
+    #evaluate all of the leaves up front across the engines instead of one at a time during the DP
+    prefetch_evaluations(book_leaves(roots))
+
+    previous_superbooks = None
+    for round_i in range(refine_rounds):
+        print("generating books")
+        superbooks = [None] * len(configs)
+        for n in sorted({config["move_cnt"] for config in configs}):
+            indices = [i for i, config in enumerate(configs) if config["move_cnt"] == n]
+            n_roots = [roots[i] for i in indices]
+            if worker_cnt > 1:
+                n_superbooks = compute_books_parallel(n_roots, n, nodes, worker_cnt)
+            else:
+                n_superbooks = compute_books(n_roots, n)
+            for i, superbook in zip(indices, n_superbooks):
+                superbooks[i] = superbook
+
+        for i, (config, superbook) in enumerate(zip(configs, superbooks)):
+            if "name" in config:
+                name = config["name"]
+            elif len(configs) == 1:
+                name = config["side"]
+            else:
+                name = f"{config['side']}_{config['move_cnt']}_{i}"
+            print_book(superbook, name, positions)
+        print(f"superbook cache: {superbook_cache.stats()}")
+        if previous_superbooks:
+            ev_changes = [new.get_total_ev(new.get_size()) - old.get_total_ev(old.get_size()) for old, new in zip(previous_superbooks, superbooks)]
+            print(f"round {round_i} total ev changes: {ev_changes}")
+        previous_superbooks = superbooks
+
+        start_nodes = [nodes[config["starting_fen"]] for config in configs]
+        refined_cnt = refine_evaluations(superbooks, start_nodes, refine_time_budget, refine_engine_budget)
+        if refined_cnt == 0:
+            break
+    return superbooks
+
+def generate_book(starting_fen, move_cnt, side, nodes, positions, worker_cnt=BOOK_WORKER_CNT, refine_rounds=1, refine_time_budget=REFINE_TIME_BUDGET, refine_engine_budget=REFINE_ENGINE_BUDGET):
+    config = {"starting_fen": starting_fen, "move_cnt": move_cnt, "side": side}
+    return generate_books([config], nodes, positions, worker_cnt, refine_rounds, refine_time_budget, refine_engine_budget)[0]
+
+def book_leaf_probs(superbook, start_node):
+    #most likely leaves of the biggest book in superbook: [(fen, prob)]
     book = list(superbook.get_all_books())[-1] #.get_book(superbook.get_size()) #biggest book in the superbook
     book_hash = {} #fen: (fen, move, total_ev)
     for x in book.get_moves():
@@ -1339,24 +1764,89 @@ def generate_book(starting_fen, move_cnt, side, nodes, positions):
         if fen not in book_hash or value > book_hash[fen][2]:
             book_hash[fen] = x
 
-    top_leaves, biggest_errors = get_book_info(book_hash, start_node, 1, 250) #top 250 positions
+    top_leaves, biggest_errors = get_book_info(book_hash, start_node, 1, REFINE_LEAF_CNT)
     print(top_leaves)
     print(biggest_errors)
-    for fen,prob in top_leaves:
-        evaluate_pseudo_fen(fen, 8000 * EVAL_TIME * prob)[1] #compute these nodes in depth proportional to their likelihood
-    print("done refining evaluations")
-
-if __name__ == "__main__":
-    #move_history -> {fen, move_cnts:{move: cnt}, total_cnt}
-    positions = generate_position_stats()
+    return top_leaves
+
+def refine_priority(prob, eval_time):
+    #(priority, time of the next search) for a leaf reached with prob that has been searched for eval_time,
+    #or None once it's been searched for REFINE_MAX_EVAL_TIME
+    #the priority is the leaf's prob times the evaluation error that the next search removes,
+    #per engine second of the search
+    eval_time = max(eval_time, EVAL_TIME // 2) #so leaves that were never evaluated get EVAL_TIME first
+    #double the time each search since memo_eval rounds up to a power of 2 times the saved time anyway
+    next_time = 2 * eval_time
+    if next_time > REFINE_MAX_EVAL_TIME:
+        return None
+    return prob * (eval_error(eval_time) - eval_error(next_time)) / (next_time / 1000), next_time
+
+def refine_evaluations(superbooks, start_nodes, time_budget=REFINE_TIME_BUDGET, engine_budget=REFINE_ENGINE_BUDGET):
+    #Refine evaluations:
+    #the above evaluations are 1 second per move, which gives some inaccuracies
+    #and the opening book will suggest some moves that look good based on 1 second
+    #of evaluation but wouldn't after a longer evaluation. So after computing the opening books,
+    #rerun their most likely leaves with longer evals and then generate the opening books again
+    #
+    #leaves are searched in order of refine_priority across EVALUATOR's engines and go back
+    #in the queue with a longer search after each one finishes. Refining stops at the first
+    #search that would go past time_budget wall clock seconds or engine_budget engine seconds
+    #returns the number of leaves whose evaluations changed
+    print("refining evaluations")
+    leaf_probs = {} #fen: prob summed over the books
+    for superbook, start_node in zip(superbooks, start_nodes):
+        for fen, prob in book_leaf_probs(superbook, start_node):
+            leaf_probs[fen] = leaf_probs.get(fen, 0) + prob
+    start_eval_times = {fen: pseudo_fen_eval_time(fen) for fen in leaf_probs}
+
+    queue = [] #(-priority, fen, next search time)
+    def push(fen):
+        priority = refine_priority(leaf_probs[fen], pseudo_fen_eval_time(fen))
+        if priority is not None:
+            heapq.heappush(queue, (-priority[0], fen, priority[1]))
+    for fen in leaf_probs:
+        push(fen)
+
+    start_time = time.time()
+    engine_seconds = 0
+    search_cnt = 0
+    searches = {} #future: fen
+    with concurrent.futures.ThreadPoolExecutor(max_workers=EVALUATOR.engine_cnt) as executor:
+        while queue or searches:
+            while queue and len(searches) < EVALUATOR.engine_cnt:
+                #search times are known up front, so don't start a search that would end past a budget
+                if time_budget is not None and time.time() - start_time + queue[0][2] / 1000 > time_budget:
+                    break
+                if engine_budget is not None and engine_seconds + queue[0][2] / 1000 > engine_budget:
+                    break
+                _, fen, next_time = heapq.heappop(queue)
+                searches[executor.submit(evaluate_pseudo_fen, fen, next_time)] = fen
+                engine_seconds += next_time / 1000
+                search_cnt += 1
+            if not searches:
+                break #out of budget
+            done, _ = concurrent.futures.wait(searches, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                future.result()
+                push(searches.pop(future))
+    EVALUATOR.save_evals()
 
-    print(f"position cnt: {len(positions)}")
-    print(sys.getsizeof(positions))
+    refined_cnt = 0
+    for fen in leaf_probs:
+        if pseudo_fen_eval_time(fen) != start_eval_times[fen]:
+            mark_dirty(fen)
+            refined_cnt += 1
+    print(f"done refining evaluations: {search_cnt} searches of {refined_cnt} leaves, {engine_seconds:.0f} engine seconds in {time.time() - start_time:.0f} seconds")
+    return refined_cnt
 
+if __name__ == "__main__":
     #game tree
     #nodes contain list of children
     #along with the probability,
-    nodes = generate_game_tree(positions)
+    #positions: fen -> {fen, move_cnts:{move: cnt}, total_cnt}
+    nodes, positions = load_game_graph()
+
+    print(f"position cnt: {len(positions)}")
 
     starting_history = [] #['e2e4', 'e7e5'] #['e2e4', 'g8f6'] #['e2e4', 'g8f6', 'e4e5', 'f6d5']
     starting_fen = move_history_to_pseudo_fen(str(starting_history))
@@ -1369,6 +1859,10 @@ if __name__ == "__main__":
     # generate_book(starting_fen, move_cnt, "white", nodes, positions)
     generate_book(starting_fen, move_cnt, "black", nodes, positions) #MUST: CLEAR OUT THE COUNTERS INSIDE generate_book
 
+    #or several books together, eg both sides at a few sizes:
+    # configs = [{"starting_fen": starting_fen, "move_cnt": cnt, "side": side} for side in ["white", "black"] for cnt in [50, 200, 1000]]
+    # generate_books(configs, nodes, positions)
+
 
     print(LEAF_COUNT)
 
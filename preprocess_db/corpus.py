@@ -0,0 +1,173 @@
+import numpy as np
+import argparse
+import hashlib
+import json
+import os
+
+from eval_store import encode_move
+from pgn_index import iter_game_spans, read_game_at
+from mainline_pgn import read_mainline_game
+from pgn_to_moves import map_byte_ranges, zobrist_replay, filtered_positions, write_positions, INGEST_WORKER_CNT, FILTER_MIN_CNT
+from position_counts import PositionCounter, COUNT_DTYPE, aggregate, position_key
+
+#Position move counts for a corpus of pgn files, kept as one shard per pgn
+#so adding a new pgn (eg next month's lichess dump) only parses that file
+#
+#each shard holds the aggregated (position, move) counts of one pgn
+#(see position_counts.py) and is tagged with the sha256 of the pgn, so
+#re-adding an unchanged file is skipped and a changed file replaces its shard.
+#The filtered_moves csv for opening_book.py is made by merging the shards
+#
+#usage:
+#python3 corpus.py add corpus_dir games1.pgn [games2.pgn ...]
+#python3 corpus.py filter corpus_dir filtered_moves.csv
+
+CORPUS_DIR = "/ssd/files/chess/corpus"
+
+#first (see position_counts.py) packs where a pair was first seen:
+#shard number << 48 | game byte offset << 12 | ply
+#plies past MAX_PLY are too deep for the opening book and aren't counted
+OFFSET_BITS = 36
+PLY_BITS = 12
+MAX_PLY = 2**PLY_BITS - 1
+
+def readCL():
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest="command")
+    add_parser = subparsers.add_parser("add", help="add or update the shards for pgn files")
+    add_parser.add_argument("corpus_dir")
+    add_parser.add_argument("pgn_files", nargs="+")
+    filter_parser = subparsers.add_parser("filter", help="write the filtered_moves csv for the corpus")
+    filter_parser.add_argument("corpus_dir")
+    filter_parser.add_argument("out_file")
+    filter_parser.add_argument("--min_cnt", type=int, default=FILTER_MIN_CNT)
+    args = parser.parse_args()
+    return args
+
+def file_hash(filename):
+    h = hashlib.sha256()
+    with open(filename, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            h.update(block)
+    return h.hexdigest()
+
+def count_byte_range(pgn_file, start, end):
+    #worker for add_pgn: aggregated counts for the games starting in [start, end)
+    #games from a FEN setup position are skipped since their move histories
+    #don't start from the initial position
+    keys = []
+    moves = []
+    firsts = []
+    with open(pgn_file, "rb") as f:
+        for offset, length, headers in iter_game_spans(f, start, end):
+            if "FEN" in headers:
+                continue
+            game = read_game_at(f, offset, length, read_mainline_game)
+            board = game.board()
+            game_moves = game.mainline_moves()[:MAX_PLY+1]
+            for ply, (zobrist, move) in enumerate(zip(zobrist_replay(board, game_moves), game_moves)):
+                keys.append(position_key(zobrist, board.fullmove_number))
+                moves.append(encode_move(move.uci()))
+                firsts.append((offset << PLY_BITS) | ply)
+    rows = np.zeros(len(keys), dtype=COUNT_DTYPE)
+    rows["key"] = np.array(keys, dtype=np.uint64)
+    rows["move"] = moves
+    rows["cnt"] = 1
+    rows["first"] = np.array(firsts, dtype=np.uint64)
+    return aggregate(rows)
+
+class Corpus():
+    def __init__(self, corpus_dir=CORPUS_DIR):
+        self.corpus_dir = corpus_dir
+        os.makedirs(corpus_dir, exist_ok=True)
+        self.manifest_file = os.path.join(corpus_dir, "manifest.json")
+        self.shards = [] #{"pgn", "sha256", "parts"} in the order added, stored in <corpus_dir>/<sha256>/
+        if os.path.exists(self.manifest_file):
+            with open(self.manifest_file) as f:
+                self.shards = json.load(f)["shards"]
+    def save_manifest(self):
+        tmp_file = self.manifest_file + ".tmp"
+        with open(tmp_file, "w") as f_out:
+            json.dump({"shards": self.shards}, f_out, indent=2)
+        os.replace(tmp_file, self.manifest_file)
+    def add_pgn(self, pgn_file, worker_cnt=INGEST_WORKER_CNT):
+        #returns False if the shard for this content is already in the corpus
+        pgn_file = os.path.abspath(pgn_file)
+        if os.path.getsize(pgn_file) >= 2**OFFSET_BITS:
+            raise Exception(f"{pgn_file} is too large for the game offsets in a shard, split it")
+        sha256 = file_hash(pgn_file)
+        if any(shard["sha256"] == sha256 for shard in self.shards):
+            print(f"skipping {pgn_file}, already ingested")
+            return False
+
+        shard_dir = os.path.join(self.corpus_dir, sha256)
+        os.makedirs(shard_dir, exist_ok=True)
+        with PositionCounter(spill_dir=self.corpus_dir) as counter:
+            for rows in map_byte_ranges(pgn_file, count_byte_range, worker_cnt):
+                counter.add_rows(rows)
+            #merged slices are sorted and cover disjoint key ranges
+            part_cnt = 0
+            for rows in counter.merged():
+                np.save(os.path.join(shard_dir, f"part{part_cnt}.npy"), rows)
+                part_cnt += 1
+
+        #an updated version of a file replaces the old shard
+        for shard in list(self.shards):
+            if shard["pgn"] == pgn_file:
+                print(f"replacing the shard for the old version of {pgn_file}")
+                self.remove_shard(shard)
+        self.shards.append({"pgn": pgn_file, "sha256": sha256, "parts": part_cnt})
+        self.save_manifest()
+        return True
+    def remove_shard(self, shard):
+        self.shards.remove(shard)
+        shard_dir = os.path.join(self.corpus_dir, shard["sha256"])
+        for i in range(shard["parts"]):
+            os.remove(os.path.join(shard_dir, f"part{i}.npy"))
+        os.rmdir(shard_dir)
+        self.save_manifest()
+    def shard_parts(self, i):
+        shard = self.shards[i]
+        for part in range(shard["parts"]):
+            rows = np.load(os.path.join(self.corpus_dir, shard["sha256"], f"part{part}.npy"))
+            rows["first"] |= np.uint64(i << (OFFSET_BITS + PLY_BITS))
+            yield rows
+    def counter(self):
+        #PositionCounter with the counts of every shard
+        counter = PositionCounter(spill_dir=self.corpus_dir)
+        for i in range(len(self.shards)):
+            for rows in self.shard_parts(i):
+                counter.add_rows(rows)
+        return counter
+    def read_history(self, first):
+        #uci moves before the position first seen at first
+        shard = self.shards[first >> (OFFSET_BITS + PLY_BITS)]
+        offset = (first >> PLY_BITS) & (2**OFFSET_BITS - 1)
+        ply = first & MAX_PLY
+        if shard["pgn"] not in self.pgn_files:
+            self.pgn_files[shard["pgn"]] = open(shard["pgn"], "rb")
+        f = self.pgn_files[shard["pgn"]]
+        for offset, length, headers in iter_game_spans(f, offset):
+            game = read_game_at(f, offset, length, read_mainline_game)
+            return [move.uci() for move in game.mainline_moves()[:ply]]
+    def write_filtered(self, out_file, min_cnt=FILTER_MIN_CNT):
+        #same output as pgn_to_moves.filter_csv, for the whole corpus
+        with self.counter() as counter:
+            positions = filtered_positions(counter, min_cnt)
+        self.pgn_files = {} #pgn -> open file for read_history
+        try:
+            write_positions(out_file, positions, self.read_history)
+        finally:
+            for f in self.pgn_files.values():
+                f.close()
+
+if __name__ == "__main__":
+    args = readCL()
+    if args.command == "add":
+        corpus = Corpus(args.corpus_dir)
+        for pgn_file in args.pgn_files:
+            corpus.add_pgn(pgn_file)
+    elif args.command == "filter":
+        Corpus(args.corpus_dir).write_filtered(args.out_file, args.min_cnt)
+    else:
+        raise Exception(f"unknown command: {args.command}")
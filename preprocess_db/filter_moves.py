@@ -1,26 +1,84 @@
+import numpy as np
+import hashlib
+import tempfile
 import csv
 
 #filter a list of moves to include only positions with
 #a minimum number of occurrences
+#
+#positions are counted by a 64 bit key of the fen without the move clocks,
+#so transpositions count together. Counting every key exactly takes memory
+#in proportion to the number of distinct positions, so instead:
+#1. count all keys in a count-min sketch, which has a fixed size and never undercounts
+#2. count exactly only the keys the sketch puts at MIN_CNT or more, and save their rows
+#3. write the saved rows whose exact count is at least MIN_CNT
 
-if __name__ == "__main__":
-    #filter to have only the move histories with a minimum frequency (TODO: use zobrist hashes instead)
-    MIN_CNT = 20
+MIN_CNT = 20
+INPUT_FILE = "/tmp/moves.csv"
+OUTPUT_FILE = "/tmp/filtered_moves.csv"
+
+SKETCH_WIDTH = 2**24 #counters per row, a power of 2
+SKETCH_DEPTH = 4 #rows, each with its own hash. memory is 4 * width * depth bytes
+CHUNK_ROWS = 100000
+
+def fen_key(fen):
+    #the zobrist hash would need a chess.Board for every row, which is ~100x slower
+    position = fen.rsplit(" ", 2)[0]
+    return int.from_bytes(hashlib.blake2b(position.encode(), digest_size=8).digest(), "little")
+
+class CountMinSketch():
+    def __init__(self, width=SKETCH_WIDTH, depth=SKETCH_DEPTH):
+        self.shift = np.uint64(64 - (width.bit_length() - 1))
+        self.counts = np.zeros((depth, width), dtype=np.uint32)
+        #odd multipliers for multiply-shift hashing of the (already random) keys
+        rng = np.random.default_rng(0)
+        self.multipliers = rng.integers(0, 2**63, size=depth, dtype=np.uint64) * np.uint64(2) + np.uint64(1)
+    def indices(self, keys):
+        return [(keys * m) >> self.shift for m in self.multipliers]
+    def add(self, keys):
+        keys = np.asarray(keys, dtype=np.uint64)
+        for row, idx in zip(self.counts, self.indices(keys)):
+            np.add.at(row, idx, 1)
+    def estimate(self, keys):
+        keys = np.asarray(keys, dtype=np.uint64)
+        return np.min([row[idx] for row, idx in zip(self.counts, self.indices(keys))], axis=0)
+
+def read_chunks(filename):
+    #lists of up to CHUNK_ROWS rows of a csv
+    with open(filename) as csvfile:
+        chunk = []
+        for row in csv.DictReader(csvfile):
+            chunk.append(row)
+            if len(chunk) >= CHUNK_ROWS:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+
+def filter_moves(input_file=INPUT_FILE, output_file=OUTPUT_FILE, min_cnt=MIN_CNT):
+    sketch = CountMinSketch()
+    for chunk in read_chunks(input_file):
+        sketch.add([fen_key(row["fen"]) for row in chunk])
 
     cnts = {}
+    with tempfile.TemporaryFile("w+") as candidates:
+        writer = csv.writer(candidates)
+        for chunk in read_chunks(input_file):
+            keys = [fen_key(row["fen"]) for row in chunk]
+            for row, key, estimate in zip(chunk, keys, sketch.estimate(keys)):
+                if estimate >= min_cnt:
+                    cnts[key] = cnts.setdefault(key,0) + 1
+                    writer.writerow([key, row["fen"], row["move_history"], row["move"]])
+        del sketch
 
-    #read through the file twice
-    with open("/tmp/moves.csv") as csvfile:
-        reader = csv.DictReader(csvfile)
-        for row in reader:
-            cnts[row["move_history"]] = cnts.setdefault(row["move_history"],0) + 1
-
-    with open("/tmp/filtered_moves.csv", 'w') as csvfile:
-        fieldnames = ["start_fen", "move_history", "move"]
-        writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
-        writer.writeheader()
-        with open("/tmp/moves.csv") as csvfile:
-            reader = csv.DictReader(csvfile)
-            for row in reader:
-                if cnts[row["move_history"]] >= MIN_CNT:
-                    writer.writerow({"start_fen":row["fen"], "move_history": row["move_history"], "move":row["move"]})
+        candidates.seek(0)
+        with open(output_file, 'w') as csvfile:
+            fieldnames = ["start_fen", "move_history", "move"]
+            writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
+            writer.writeheader()
+            for key, fen, move_history, move in csv.reader(candidates):
+                if cnts[int(key)] >= min_cnt:
+                    writer.writerow({"start_fen":fen, "move_history": move_history, "move":move})
+
+if __name__ == "__main__":
+    filter_moves()
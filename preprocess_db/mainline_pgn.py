@@ -0,0 +1,102 @@
+import chess
+import re
+
+#Fast pgn reader for code that only walks the mainline
+#chess.pgn.read_game builds the full tree of variations, comments and NAGs
+#which we never read. This skips them while tokenizing and keeps only the
+#headers and the mainline SAN moves, which are parsed on first use.
+#MainlineGame has the parts of the chess.pgn.Game interface that
+#pgn_to_moves.Game and the other readers use: headers, board(), mainline_moves()
+
+#comments, variation brackets and everything else up to whitespace or a bracket
+TOKEN_RE = re.compile(r"\{[^}]*\}?|;[^\n]*|[()]|[^\s(){};]+")
+MOVE_NUMBER_RE = re.compile(r"^\d+\.+")
+HEADER_RE = re.compile(r'^\[(\w+)\s+"(.*)"\]')
+RESULTS = {"1-0", "0-1", "1/2-1/2", "*"}
+
+class MainlineGame():
+    def __init__(self, headers, sans, text):
+        self.headers = headers
+        self.sans = sans
+        self.text = text
+        self.moves = None
+    def board(self):
+        if "FEN" in self.headers:
+            return chess.Board(self.headers["FEN"])
+        return chess.Board()
+    def mainline_moves(self):
+        if self.moves is None:
+            #like chess.pgn.read_game, stop at the first illegal move
+            self.moves = []
+            board = self.board()
+            for san in self.sans:
+                try:
+                    move = board.push_san(san)
+                except ValueError:
+                    break
+                self.moves.append(move)
+        return self.moves
+    def __str__(self):
+        return self.text
+
+def parse_mainline(movetext):
+    #mainline SAN moves from pgn movetext
+    sans = []
+    depth = 0 #variation nesting
+    for match in TOKEN_RE.finditer(movetext):
+        token = match.group(0)
+        if token[0] in "{;$":
+            continue
+        elif token == "(":
+            depth += 1
+        elif token == ")":
+            depth = max(depth - 1, 0)
+        elif depth == 0:
+            if token in RESULTS:
+                break
+            token = MOVE_NUMBER_RE.sub("", token).rstrip("!?")
+            if token:
+                sans.append(token)
+    return sans
+
+def iter_mainline_games(handle):
+    #yield a MainlineGame for each game in a text pgn file
+    line = handle.readline()
+    while True:
+        lines = []
+        headers = {}
+        while line and not line.strip(): #skip blank lines before the game
+            line = handle.readline()
+        if not line:
+            return
+
+        while line.startswith("["):
+            lines.append(line)
+            match = HEADER_RE.match(line)
+            if match:
+                headers[match.group(1)] = match.group(2)
+            line = handle.readline()
+
+        #movetext runs until a blank line, unless the blank line is inside a comment
+        #a header line before any movetext means the game had no moves
+        movetext = []
+        open_comment = False
+        while line:
+            if not line.strip() and movetext and not open_comment:
+                break
+            if line.startswith("[") and not movetext:
+                break
+            lines.append(line)
+            if line.strip():
+                movetext.append(line)
+            if "{" in line or open_comment:
+                text = "".join(movetext)
+                open_comment = text.count("{") > text.count("}")
+            line = handle.readline()
+
+        yield MainlineGame(headers, parse_mainline("".join(movetext)), "".join(lines))
+
+def read_mainline_game(handle):
+    #same as chess.pgn.read_game but returns a MainlineGame, None at the end of the file
+    #reads one line past the game, so use iter_mainline_games to read a whole file
+    return next(iter_mainline_games(handle), None)
@@ -0,0 +1,94 @@
+import numpy as np
+import json
+import os
+
+#Binary version of moves.csv: one row per move with each column in its own
+#file under the table directory, so readers memory map only the columns they use
+#
+#table = MoveTable.load("/tmp/moves.table")
+#rows = (table["white_elo"] > 2600) & (table["black_elo"] > 2600)
+#zobrists = table["zobrist"][rows]
+#
+#zobrist is chess.polyglot.zobrist_hash of the position before the move
+#move is the move encoded as in eval_store.encode_move
+#the move history of a row is the moves of the rows of the same game with a lower ply
+#result is coded as in pgn_index.RESULT_CODES
+#
+#written by pgn_to_moves.pgn_to_move_table
+
+COLUMNS = {
+    "zobrist": "<u8",
+    "move": "<u2",
+    "game": "<u4",
+    "ply": "<u2",
+    "turn": "<i1",
+    "white_elo": "<i2",
+    "black_elo": "<i2",
+    "result": "<i1"
+}
+
+def column_file(table_dir, column):
+    return os.path.join(table_dir, column + ".bin")
+
+class MoveTableWriter():
+    #appends chunks of rows to each column file
+    #the table can't be read until close() writes meta.json
+    def __init__(self, table_dir):
+        self.table_dir = table_dir
+        os.makedirs(table_dir, exist_ok=True)
+        meta_file = os.path.join(table_dir, "meta.json")
+        if os.path.exists(meta_file):
+            os.remove(meta_file)
+        self.files = {column: open(column_file(table_dir, column), "wb") for column in COLUMNS}
+        self.row_cnt = 0
+    def append(self, columns):
+        #columns: column -> array or list, all the same length
+        lengths = {len(columns[column]) for column in COLUMNS}
+        if len(lengths) != 1:
+            raise Exception(f"columns have different lengths: {lengths}")
+        for column, dtype in COLUMNS.items():
+            np.asarray(columns[column], dtype=dtype).tofile(self.files[column])
+        self.row_cnt += lengths.pop()
+    def close(self, complete=True):
+        #complete=False closes the files without writing meta.json, so a partial table can't be loaded
+        for f in self.files.values():
+            f.close()
+        if not complete:
+            return
+        meta = {"rows": self.row_cnt, "columns": COLUMNS}
+        with open(os.path.join(self.table_dir, "meta.json"), "w") as f_out:
+            json.dump(meta, f_out)
+    def __enter__(self):
+        return self
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close(complete=exc_type is None)
+
+class MoveTable():
+    def __init__(self, table_dir, meta):
+        self.table_dir = table_dir
+        self.row_cnt = meta["rows"]
+        self.dtypes = meta["columns"]
+        self.columns = {}
+    @staticmethod
+    def exists(table_dir):
+        return os.path.exists(os.path.join(table_dir, "meta.json"))
+    @staticmethod
+    def load(table_dir):
+        with open(os.path.join(table_dir, "meta.json")) as f:
+            meta = json.load(f)
+        return MoveTable(table_dir, meta)
+    def __getitem__(self, column):
+        #memory mapped column, loaded on first use
+        if column not in self.columns:
+            if self.row_cnt == 0:
+                self.columns[column] = np.zeros(0, dtype=self.dtypes[column])
+            else:
+                self.columns[column] = np.memmap(column_file(self.table_dir, column), dtype=self.dtypes[column], mode="r", shape=(self.row_cnt,))
+        return self.columns[column]
+    def __len__(self):
+        return self.row_cnt
+    def chunks(self, columns, chunk_rows=10000000):
+        #yield {column: array} for consecutive blocks of rows
+        #for passes over tables too large to hold a column in memory
+        for start in range(0, self.row_cnt, chunk_rows):
+            yield {column: np.asarray(self[column][start:start+chunk_rows]) for column in columns}
@@ -0,0 +1,163 @@
+import chess.pgn
+import numpy as np
+import argparse
+import json
+import io
+import os
+import re
+
+#Byte offset index of the games in a pgn file, along with the headers we filter on
+#stored as one .npy file per column in <pgn_file>.idx/ so queries only load
+#(memory map) the columns they use, eg 2600+ decisive games that aren't rapid:
+#
+#index = PgnIndex.load(pgn_file)
+#rows = (index.max_elo() > 2600) & index.decisive() & ~index.string_mask("event", ["Rapid", "Blitz"])
+#for game in index.read_games(rows): ...
+#
+#usage: python3 pgn_index.py -f games.pgn
+
+HEADER_RE = re.compile(rb'^\[(\w+)\s+"(.*)"\]')
+
+#game results as in pgn_to_moves.Game.result(), doubled to fit an int8
+RESULT_CODES = {"1-0": 2, "1/2-1/2": 1, "0-1": 0}
+RESULT_UNKNOWN = -1
+
+#string headers are stored as codes into a table of distinct values
+STRING_COLUMNS = {"event": "Event", "white": "White", "black": "Black", "time_control": "TimeControl"}
+
+def readCL():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-f","--infile", help="pgn file to index")
+    args = parser.parse_args()
+    return args
+
+def iter_game_spans(f, start=0, end=None):
+    #yield (offset, length, headers) for each game in the binary file f that
+    #starts in the byte range [start, end). start must be the start of a game
+    #games start at lines beginning with "[Event ", like every pgn we use
+    f.seek(start)
+    offset = start
+    game_offset = None
+    headers = None
+    while True:
+        line = f.readline()
+        if not line or line.startswith(b"[Event "):
+            if game_offset is not None:
+                #callers may read the game from f, so restore the position afterwards
+                position = f.tell()
+                yield game_offset, offset - game_offset, headers
+                f.seek(position)
+            if not line or (end is not None and offset >= end):
+                break
+            game_offset = offset
+            headers = {}
+        if game_offset is not None and line.startswith(b"["):
+            match = HEADER_RE.match(line)
+            if match:
+                headers[match.group(1).decode("utf-8", errors="replace")] = match.group(2).decode("utf-8", errors="replace")
+        offset += len(line)
+
+def read_game_at(f, offset, length, reader=chess.pgn.read_game):
+    #read one game from a pgn file opened in binary mode
+    #reader: chess.pgn.read_game or another function that reads a game from a text handle
+    f.seek(offset)
+    return reader(io.StringIO(f.read(length).decode("utf-8", errors="replace")))
+
+def parse_elo(elo):
+    try:
+        return int(elo)
+    except (TypeError, ValueError):
+        return 0
+
+def parse_date(date):
+    #"2018.10.01" -> 20181001, unknown parts ("??") are 0
+    parts = (date or "").split(".")
+    parts = [int(x) if x.isdigit() else 0 for x in parts] + [0,0,0]
+    return parts[0] * 10000 + parts[1] * 100 + parts[2]
+
+def index_dir(pgn_file):
+    return pgn_file + ".idx"
+
+def build_index(pgn_file):
+    columns = {"offset": [], "length": [], "white_elo": [], "black_elo": [], "eco": [], "date": [], "result": []}
+    strings = {column: {} for column in STRING_COLUMNS} #column -> {value: code}
+    for column in STRING_COLUMNS:
+        columns[column] = []
+
+    cnt = 0
+    with open(pgn_file, "rb") as f:
+        for offset, length, headers in iter_game_spans(f):
+            cnt += 1
+            if cnt % 100000 == 0: print(cnt)
+            columns["offset"].append(offset)
+            columns["length"].append(length)
+            columns["white_elo"].append(parse_elo(headers.get("WhiteElo")))
+            columns["black_elo"].append(parse_elo(headers.get("BlackElo")))
+            columns["eco"].append(headers.get("ECO", ""))
+            columns["date"].append(parse_date(headers.get("Date")))
+            columns["result"].append(RESULT_CODES.get(headers.get("Result"), RESULT_UNKNOWN))
+            for column, header in STRING_COLUMNS.items():
+                value = headers.get(header, "")
+                columns[column].append(strings[column].setdefault(value, len(strings[column])))
+
+    dtypes = {"offset": np.int64, "length": np.int64, "white_elo": np.int16, "black_elo": np.int16, "eco": "S3", "date": np.int32, "result": np.int8}
+    dtypes.update({column: np.int32 for column in STRING_COLUMNS})
+
+    out_dir = index_dir(pgn_file)
+    os.makedirs(out_dir, exist_ok=True)
+    for column in columns:
+        np.save(os.path.join(out_dir, column + ".npy"), np.array(columns[column], dtype=dtypes[column]))
+    stat = os.stat(pgn_file)
+    meta = {
+        "pgn_size": stat.st_size,
+        "pgn_mtime": stat.st_mtime,
+        "strings": {column: list(strings[column]) for column in STRING_COLUMNS}
+    }
+    with open(os.path.join(out_dir, "meta.json"), "w") as f_out:
+        json.dump(meta, f_out)
+    return PgnIndex.load(pgn_file)
+
+class PgnIndex():
+    def __init__(self, pgn_file, meta):
+        self.pgn_file = pgn_file
+        self.strings = meta["strings"]
+        self.columns = {}
+    @staticmethod
+    def exists(pgn_file):
+        return os.path.exists(os.path.join(index_dir(pgn_file), "meta.json"))
+    @staticmethod
+    def load(pgn_file):
+        with open(os.path.join(index_dir(pgn_file), "meta.json")) as f:
+            meta = json.load(f)
+        stat = os.stat(pgn_file)
+        if stat.st_size != meta["pgn_size"] or stat.st_mtime != meta["pgn_mtime"]:
+            raise Exception(f"index for {pgn_file} is out of date, rerun pgn_index.py")
+        return PgnIndex(pgn_file, meta)
+    def __getitem__(self, column):
+        #memory mapped column, loaded on first use
+        if column not in self.columns:
+            self.columns[column] = np.load(os.path.join(index_dir(self.pgn_file), column + ".npy"), mmap_mode="r")
+        return self.columns[column]
+    def __len__(self):
+        return len(self["offset"])
+    def max_elo(self):
+        return np.maximum(self["white_elo"], self["black_elo"])
+    def decisive(self):
+        return (self["result"] == RESULT_CODES["1-0"]) | (self["result"] == RESULT_CODES["0-1"])
+    def string_mask(self, column, substrings):
+        #games whose string header contains any of the substrings
+        #matched against the (small) table of distinct values, not every game
+        codes = [code for code, value in enumerate(self.strings[column]) if any(x in value for x in substrings)]
+        return np.isin(self[column], codes)
+    def read_games(self, rows=None, reader=chess.pgn.read_game):
+        #rows: boolean mask or row numbers, default every game
+        offsets = self["offset"] if rows is None else self["offset"][rows]
+        lengths = self["length"] if rows is None else self["length"][rows]
+        with open(self.pgn_file, "rb") as f:
+            for offset, length in zip(offsets, lengths):
+                yield read_game_at(f, int(offset), int(length), reader)
+
+if __name__ == "__main__":
+    args = readCL()
+    index = build_index(args.infile)
+    print(f"indexed {len(index)} games")
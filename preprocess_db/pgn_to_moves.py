@@ -5,12 +5,23 @@ import chess.pgn
 import chess.polyglot
 import csv
 import random
+import array
+import re
 
 import hashlib
 import math
 import base64
+import numpy as np
+import collections
+import multiprocessing
+import os
 
 from eval_moves import fen_plus_move, move_history_to_fen
+from eval_store import encode_move, decode_move
+from pgn_index import PgnIndex, iter_game_spans, read_game_at, parse_elo, RESULT_CODES, RESULT_UNKNOWN
+import move_table
+from position_counts import PositionCounter, position_key
+from mainline_pgn import iter_mainline_games, read_mainline_game
 
 #TODO: lots of unused code here, try to remove it
 #Read in a pgn list of games and generate a csv of moves
@@ -22,14 +33,79 @@ PGN_FILE = "/home/jtrigg/files/misc/KingBase2018-all.pgn"
 CEREBELLUM_FILE = "/home/jtrigg/Downloads/Cerebellum_light_180611/Cerebellum_Light_Poly.bin"
 
 MAX_GAME_CNT = 100000000
+#read games with the mainline-only reader from mainline_pgn.py
+#instead of building full chess.pgn game trees
+MAINLINE_ONLY = True
 GAME_FRAC = 1 #0.03 TODO: think this is being used in two places right now, should be fixed before using
 MOVE_FRAC = 1 #0.03
 
 
+MOVES_FILE = "/tmp/moves.csv"
+MOVE_TABLE_DIR = "/tmp/moves.table" #see move_table.py
+MOVES_FIELDNAMES = ["white_elo", "black_elo", "result", "move_history", "turn", "fen", "move"]
+INGEST_WORKER_CNT = os.cpu_count() or 1
+INGEST_SHARD_BYTES = 16 * 1024 * 1024 #max size of the byte ranges handed to each worker
+
 FILTER_MIN_CNT = 20 #None
+GAMES_FILE = "/ssd/files/chess/games.csv" #written by pgn_to_csv
+FILTERED_MOVES_FILE = "/ssd/files/chess/filtered_moves_20200309.csv"
+MOVE_LIST_RE = re.compile(rb"'(\w+)'") #uci moves in a games.csv row
 PARALLEL_TOTAL = 10 # PARALLEL_TOTAL times, each
 PARALLEL_ID = None #seed takes on values in range(PARALLEL_TOTAL)
 
+#polyglot zobrist keys: 768 piece-square keys, 4 castling, 8 en passant files, turn
+ZOBRIST_ARRAY = chess.polyglot.POLYGLOT_RANDOM_ARRAY
+ZOBRIST_CASTLING = [(chess.BB_H1, 768), (chess.BB_A1, 769), (chess.BB_H8, 770), (chess.BB_A8, 771)]
+
+def zobrist_piece(board, square):
+    piece = board.piece_at(square)
+    if piece is None:
+        return 0
+    return ZOBRIST_ARRAY[64 * (2 * (piece.piece_type - 1) + int(piece.color)) + square]
+
+def zobrist_state(board):
+    #castling, en passant and turn part of chess.polyglot.zobrist_hash
+    #these change with almost every move so are recomputed instead of updated
+    zobrist = 0
+    castling = board.clean_castling_rights()
+    for mask, i in ZOBRIST_CASTLING:
+        if castling & mask:
+            zobrist ^= ZOBRIST_ARRAY[i]
+    if board.ep_square is not None:
+        #only hashed if a pawn is there to take, legal or not
+        pawn_rank = chess.square_rank(board.ep_square) + (-1 if board.turn else 1)
+        ep_file = chess.square_file(board.ep_square)
+        for f in [ep_file - 1, ep_file + 1]:
+            if 0 <= f < 8 and board.piece_at(chess.square(f, pawn_rank)) == chess.Piece(chess.PAWN, board.turn):
+                zobrist ^= ZOBRIST_ARRAY[772 + ep_file]
+                break
+    if board.turn == chess.WHITE:
+        zobrist ^= ZOBRIST_ARRAY[780]
+    return zobrist
+
+def move_squares(board, move):
+    #squares whose piece changes when move is played on board
+    if board.is_castling(move):
+        #the king and rook squares, which are all on the back rank
+        return list(chess.SquareSet(chess.BB_RANKS[chess.square_rank(move.from_square)]))
+    if board.is_en_passant(move):
+        return [move.from_square, move.to_square, chess.square(chess.square_file(move.to_square), chess.square_rank(move.from_square))]
+    return [move.from_square, move.to_square]
+
+def zobrist_replay(board, moves):
+    #play moves on board, yielding chess.polyglot.zobrist_hash(board) before each
+    #one. The hash is updated from the squares each move changes rather than
+    #recomputed, and board is in the position hashed until the next value is requested
+    piece_zobrist = chess.polyglot.zobrist_hash(board) ^ zobrist_state(board)
+    for move in moves:
+        yield piece_zobrist ^ zobrist_state(board)
+        squares = move_squares(board, move)
+        for square in squares:
+            piece_zobrist ^= zobrist_piece(board, square)
+        board.push(move)
+        for square in squares:
+            piece_zobrist ^= zobrist_piece(board, square)
+
 class Game():
     def __init__(self, game):
         self.game = game
@@ -48,20 +124,40 @@ class Game():
         for move in self.game.mainline_moves():
             start_position = board.fen()
             info = {"white_elo": self.game.headers["WhiteElo"], "black_elo": self.game.headers["BlackElo"], "result": self.game.headers["Result"], "move_history": str(move_history), "turn": 1 if board.turn else -1, "fen":start_position, "move":str(move)}
-            if random.random() < MOVE_FRAC:
+            if MOVE_FRAC >= 1 or random.random() < MOVE_FRAC:
                 yield info
             #update with new move
             board.push(move)
             move_history.append(str(move))
+    def move_array(self):
+        #uci moves of the mainline, shared by the records from plies()
+        return [move.uci() for move in self.game.mainline_moves()]
+    def plies(self):
+        #compact version of moves(): yields (ply, zobrist, turn) for the position
+        #before each sampled move. The move played is move_array()[ply] and the
+        #history is move_array()[:ply]. zobrist is chess.polyglot.zobrist_hash
+        #of the position, kept up to date one move at a time
+        #use fen(ply) for the few positions that need a fen
+        board = self.game.board()
+        for ply, zobrist in enumerate(zobrist_replay(board, self.game.mainline_moves())):
+            if MOVE_FRAC >= 1 or random.random() < MOVE_FRAC:
+                yield ply, zobrist, 1 if board.turn else -1
+    def fen(self, ply):
+        #fen of the position before move ply
+        board = self.game.board()
+        for move in list(self.game.mainline_moves())[:ply]:
+            board.push(move)
+        return board.fen()
     def __str__(self):
         return str(self.game)
 
 def pgn_to_games(pgn_file=PGN_FILE, high_elo=False):
     pgn = open(pgn_file, errors="replace")
-    for i in range(MAX_GAME_CNT):
-        game = chess.pgn.read_game(pgn)
-        if not game:
-            break
+    if MAINLINE_ONLY:
+        games = iter_mainline_games(pgn)
+    else:
+        games = iter(lambda: chess.pgn.read_game(pgn), None)
+    for i, game in zip(range(MAX_GAME_CNT), games):
         # if high_elo and not (int(game.headers["WhiteElo"]) > 2600 or int(game.headers["BlackElo"]) > 2600):
         #    continue
         # event_name = game.headers["Event"].lower()
@@ -72,6 +168,18 @@ def pgn_to_games(pgn_file=PGN_FILE, high_elo=False):
         yield Game(game)
 
 def pgn_to_games_parallel(pgn_file=PGN_FILE, high_elo=False, parallel_cnt=1, parallel_id=None):
+    if PgnIndex.exists(pgn_file):
+        #use the header index (see pgn_index.py) instead of rescanning the file
+        index = PgnIndex.load(pgn_file)
+        ecos = np.unique(index["eco"])
+        selected_ecos = [eco for eco in ecos if hash_to_bin(eco.decode(), parallel_cnt) == parallel_id]
+        reader = read_mainline_game if MAINLINE_ONLY else chess.pgn.read_game
+        for game in index.read_games(np.isin(index["eco"], selected_ecos), reader):
+            if random.random() > GAME_FRAC:
+                continue
+            yield Game(game)
+        return
+
     #read through fast getting all the relevant games
     pgn = open(pgn_file, errors="replace")
     offsets = []
@@ -89,11 +197,101 @@ def pgn_to_games_parallel(pgn_file=PGN_FILE, high_elo=False, parallel_cnt=1, par
     print("here")
     for offset in offsets:
         pgn.seek(offset)
-        game =chess.pgn.read_game(pgn)
+        game = read_mainline_game(pgn) if MAINLINE_ONLY else chess.pgn.read_game(pgn)
         if random.random() > GAME_FRAC:
             continue
         yield Game(game)
 
+def split_byte_ranges(pgn_file, shard_bytes=INGEST_SHARD_BYTES):
+    #split the file into byte ranges of about shard_bytes that each start at an "[Event " line
+    size = os.path.getsize(pgn_file)
+    boundaries = [0]
+    with open(pgn_file, "rb") as f:
+        while boundaries[-1] + shard_bytes < size:
+            f.seek(boundaries[-1] + shard_bytes)
+            f.readline() #skip to the start of the next line
+            while True:
+                line_start = f.tell()
+                line = f.readline()
+                if not line or line.startswith(b"[Event "):
+                    break
+            if not line:
+                break
+            boundaries.append(line_start)
+    boundaries.append(size)
+    return list(zip(boundaries[:-1], boundaries[1:]))
+
+def ingest_byte_range(pgn_file, start, end):
+    #worker for pgn_to_moves_csv: moves.csv rows for the games starting in [start, end)
+    rows = []
+    with open(pgn_file, "rb") as f:
+        for offset, length, headers in iter_game_spans(f, start, end):
+            if random.random() > GAME_FRAC:
+                continue
+            game = Game(read_game_at(f, offset, length, read_mainline_game if MAINLINE_ONLY else chess.pgn.read_game))
+            for move in game.moves():
+                rows.append([move[x] for x in MOVES_FIELDNAMES])
+    return rows
+
+def ingest_byte_range_table(pgn_file, start, end):
+    #worker for pgn_to_move_table: (game count, move table columns) for the games starting in [start, end)
+    #game ids are numbered from 0 within the range
+    columns = {column: [] for column in move_table.COLUMNS}
+    game_cnt = 0
+    with open(pgn_file, "rb") as f:
+        for offset, length, headers in iter_game_spans(f, start, end):
+            if random.random() > GAME_FRAC:
+                continue
+            game = Game(read_game_at(f, offset, length, read_mainline_game if MAINLINE_ONLY else chess.pgn.read_game))
+            move_array = [encode_move(move) for move in game.move_array()]
+            white_elo = parse_elo(headers.get("WhiteElo"))
+            black_elo = parse_elo(headers.get("BlackElo"))
+            result = RESULT_CODES.get(headers.get("Result"), RESULT_UNKNOWN)
+            for ply, zobrist, turn in game.plies():
+                columns["zobrist"].append(zobrist)
+                columns["move"].append(move_array[ply])
+                columns["game"].append(game_cnt)
+                columns["ply"].append(ply)
+                columns["turn"].append(turn)
+                columns["white_elo"].append(white_elo)
+                columns["black_elo"].append(black_elo)
+                columns["result"].append(result)
+            game_cnt += 1
+    return game_cnt, {column: np.array(values, dtype=move_table.COLUMNS[column]) for column, values in columns.items()}
+
+def map_byte_ranges(pgn_file, worker, worker_cnt=INGEST_WORKER_CNT):
+    #parse the pgn in byte ranges across worker processes and yield worker(pgn_file, start, end)
+    #for each range in file order. ranges are small relative to the file and handed out as
+    #workers free up, so a slow range only delays its own worker. at most 2 ranges per worker
+    #are in flight, which bounds the results buffered while waiting on an earlier range
+    shard_bytes = min(INGEST_SHARD_BYTES, max(1, os.path.getsize(pgn_file) // (8 * worker_cnt)))
+    ranges = split_byte_ranges(pgn_file, shard_bytes)
+    with multiprocessing.Pool(worker_cnt) as pool:
+        pending = collections.deque()
+        for i, (start, end) in enumerate(ranges):
+            pending.append(pool.apply_async(worker, (pgn_file, start, end)))
+            while len(pending) >= 2 * worker_cnt:
+                yield pending.popleft().get()
+            if i % 100 == 0: print(f"{i} / {len(ranges)} byte ranges")
+        while pending:
+            yield pending.popleft().get()
+
+def pgn_to_moves_csv(pgn_file=PGN_FILE, out_file=MOVES_FILE, worker_cnt=INGEST_WORKER_CNT):
+    with open(out_file, "w") as f_out:
+        writer = csv.writer(f_out)
+        writer.writerow(MOVES_FIELDNAMES)
+        for rows in map_byte_ranges(pgn_file, ingest_byte_range, worker_cnt):
+            writer.writerows(rows)
+
+def pgn_to_move_table(pgn_file=PGN_FILE, out_dir=MOVE_TABLE_DIR, worker_cnt=INGEST_WORKER_CNT):
+    #binary alternative to pgn_to_moves_csv, see move_table.py
+    game_cnt = 0
+    with move_table.MoveTableWriter(out_dir) as writer:
+        for range_game_cnt, columns in map_byte_ranges(pgn_file, ingest_byte_range_table, worker_cnt):
+            columns["game"] += game_cnt
+            writer.append(columns)
+            game_cnt += range_game_cnt
+
 def basic_hash(x):
     return hashlib.md5(x.encode("UTF-8"))
 
@@ -130,7 +328,7 @@ def fetch_games_parallel(parallel_total, parallel_id):
                             writer.writerow(outrow)
 
 def pgn_to_csv():
-    with open("/ssd/files/chess/games.csv",'w') as csvfile:
+    with open(GAMES_FILE,'w') as csvfile:
         writer = csv.writer(csvfile)
         writer.writerow(["moves"])
         for game in pgn_to_games(PGN_FILE):
@@ -152,91 +350,74 @@ def drop_fen_50_moves(fen):
     pieces[-2] = "-"
     return " ".join(pieces)
 
-def filter_csv():
-    # with open("/ssd/files/chess/game_fens.csv", 'w') as outfile:
-    #     writer = csv.writer(outfile)
-    #     writer.writerow(["fens"])
-    #     with open("/ssd/files/chess/games.csv") as csvfile:
-    #         reader = csv.reader(csvfile)
-    #         cnt = 0
-    #         for r in reader:
-    #             if r[0] == "moves": continue #header
-    #             cnt += 1
-    #             if (cnt % 1000 == 0): print(cnt)
-    #             moves = eval(r[0])
-    #             fens = [fen for fen in game_moves_to_fens(moves)]
-    #             writer.writerow([fens])
-
-    with open("/ssd/files/chess/filtered_moves_20200309.csv", 'w') as outfile:
+def iter_games_csv(games_file=GAMES_FILE):
+    #yield (byte offset, moves) for each row of games.csv, reading the
+    #move list without eval() so rows can be reread with read_games_csv_row
+    with open(games_file, "rb") as f:
+        offset = len(f.readline()) #header
+        for line in f:
+            yield offset, [m.decode() for m in MOVE_LIST_RE.findall(line)]
+            offset += len(line)
+
+def read_games_csv_row(f, offset):
+    f.seek(offset)
+    return [m.decode() for m in MOVE_LIST_RE.findall(f.readline())]
+
+def filter_csv(games_file=GAMES_FILE, out_file=FILTERED_MOVES_FILE, min_cnt=FILTER_MIN_CNT):
+    #write fen, move_cnts, move_history for each position (fen without the
+    #halfmove clock) reached at least min_cnt times in games.csv
+    #positions are counted in one pass by zobrist hash and fullmove number,
+    #which together stand in for the fen, with memory bounded by spilling
+    #to disk (see position_counts.py). move_history is from the position's
+    #first occurrence and move_cnts lists moves in the order first played
+    offsets = array.array("q")
+    with PositionCounter() as counter:
+        for game_id, (offset, moves) in enumerate(iter_games_csv(games_file)):
+            if (game_id % 1000 == 0):
+                print(game_id)
+            offsets.append(offset)
+            board = chess.Board()
+            moves = [chess.Move.from_uci(m) for m in moves]
+            for ply, (zobrist, move) in enumerate(zip(zobrist_replay(board, moves), moves)):
+                key = position_key(zobrist, board.fullmove_number)
+                counter.add(key, encode_move(move.uci()), (game_id << 16) | ply)
+
+        positions = filtered_positions(counter, min_cnt)
+
+    with open(games_file, "rb") as f:
+        def read_history(first):
+            game_id, ply = first >> 16, first & 0xFFFF
+            return read_games_csv_row(f, offsets[game_id])[:ply]
+        write_positions(out_file, positions, read_history)
+
+def filtered_positions(counter, min_cnt):
+    #key -> [(first, move, cnt)] for each position a PositionCounter saw at least min_cnt times
+    positions = {}
+    for rows in counter.filtered(min_cnt):
+        for key, move, cnt, first in rows.tolist():
+            positions.setdefault(key, []).append((first, decode_move(move), cnt))
+    return positions
+
+def write_positions(out_file, positions, read_history):
+    #write the filtered_moves csv (fen, move_cnts, move_history) for positions from filtered_positions
+    #read_history(first) returns the moves up to the position's first occurrence
+    #positions are written in order of first occurrence, moves in order of first play
+    with open(out_file, 'w') as outfile:
         writer = csv.writer(outfile)
         writer.writerow(["fen","move_cnts","move_history"])
-        for seed in range(PARALLEL_TOTAL):
-            fen_cnts = {}
-            with open("/ssd/files/chess/games.csv") as csvfile:
-                with open("/ssd/files/chess/game_fens.csv") as fenfile:
-                    game_reader = csv.reader(csvfile)
-                    fen_reader = csv.reader(fenfile)
-                    game_cnt = 0
-                    for game_row, fen_row in zip(game_reader, fen_reader):
-                        if game_row[0] == "moves": continue #header
-                        game_cnt += 1
-                        if (game_cnt % 1000 == 0):
-                            print(game_cnt)
-                        moves = eval(game_row[0])
-                        fens = eval(fen_row[0])
-                        if len(moves) != len(fens):
-                            raise
-                        for i in range(len(moves)):
-                            fen = fens[i]
-                            fen = drop_fen_50_moves(fen)
-                            if hash_to_bin(fen,PARALLEL_TOTAL) == seed:
-                                fen_cnts[fen] = fen_cnts.setdefault(fen,0) + 1
-            positions = {}
-            with open("/ssd/files/chess/games.csv") as csvfile:
-                with open("/ssd/files/chess/game_fens.csv") as fenfile:
-                    game_reader = csv.reader(csvfile)
-                    fen_reader = csv.reader(fenfile)
-                    game_cnt = 0
-                    for game_row, fen_row in zip(game_reader, fen_reader):
-                        if game_row[0] == "moves": continue #header
-                        game_cnt += 1
-                        if (game_cnt % 1000 == 0):
-                            print(game_cnt)
-                        moves = eval(game_row[0])
-                        fens = eval(fen_row[0])
-                        if len(moves) != len(fens):
-                            raise
-                        for i in range(len(moves)):
-                            history = str(moves[:i])
-                            next_move = moves[i]
-                            fen = fens[i]
-                            fen = drop_fen_50_moves(fen)
-                            if fen in fen_cnts and fen_cnts[fen] >= FILTER_MIN_CNT:
-                                default = {"fen": fen, "move_cnts":{}, "move_history":history}
-                                info = positions.setdefault(fen,default)
-                                info["move_cnts"][next_move] = info["move_cnts"].setdefault(next_move,0) + 1
-
-            for fen in positions:
-                if sum(positions[fen]["move_cnts"].values()) >= FILTER_MIN_CNT:
-                    info = positions[fen]
-                    writer.writerow([fen, str(info["move_cnts"]), info["move_history"]])
-            # with open("/tmp/games.csv") as csvfile:
-            #     #set "probs":{},
-            #     reader = csv.reader(csvfile)
-            #     for r in reader:
-            #         moves = eval(r[0])
-            #         if r[0] == "moves": continue
-            #         for i in range(len(moves)):
-            #             history = moves[:i]
-            #             next_move = moves[i]
-            #             if (hash_to_bin(str(history),PARALLEL_TOTAL) == seed):
-            #                 basic_hash_val = basic_hash(str(history)).digest()
-            #                 if positions[basic_hash_val] >= FILTER_MIN_CNT:
-            #                     writer.writerow([history,next_move])
-
+        for position in sorted(positions.values(), key=min):
+            position.sort()
+            history = read_history(position[0][0])
+            board = chess.Board()
+            for move in history:
+                board.push(chess.Move.from_uci(move))
+            move_cnts = {move: cnt for first, move, cnt in position}
+            writer.writerow([drop_fen_50_moves(board.fen()), str(move_cnts), str(history)])
 
 if __name__ == "__main__":
     #OUTPUT_FILE = "/tmp/filtered_moves.csv" if FILTER_MIN_CNT else "/tmp/moves.csv"
 
+    #pgn_to_moves_csv()
+    #pgn_to_move_table()
     #pgn_to_csv()
     filter_csv()
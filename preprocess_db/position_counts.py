@@ -0,0 +1,129 @@
+import numpy as np
+import tempfile
+import shutil
+import os
+
+#Counts of (position, move) pairs over a corpus in bounded memory
+#
+#positions are 64 bit keys (see position_key). Pairs are buffered and then
+#aggregated into tables sorted by (key, move). When the tables grow past
+#max_rows they are combined and written to disk as a sorted run.
+#At the end the runs are merged one slice of the key space at a time, so
+#at most about max_rows rows are in memory at once
+#
+#counter = PositionCounter()
+#for ...: counter.add(key, move, first)
+#for rows in counter.filtered(min_cnt=20): ...
+#counter.close()
+
+#first: where the pair was first seen, smaller is earlier. Only the minimum is kept
+COUNT_DTYPE = np.dtype([("key","<u8"), ("move","<u2"), ("cnt","<u4"), ("first","<u8")])
+
+MAX_ROWS = 20000000 #aggregated rows kept in memory before spilling a run
+CHUNK_ROWS = 1000000 #pairs buffered before aggregating
+
+FULLMOVE_MIX = 0x9E3779B97F4A7C15
+
+def position_key(zobrist, fullmove=0):
+    #zobrist hash plus the fullmove number, which is part of the fen
+    #fullmove=0 gives the plain zobrist hash, so transpositions reached
+    #at different move numbers share a key
+    return zobrist ^ ((fullmove * FULLMOVE_MIX) & 0xFFFFFFFFFFFFFFFF)
+
+def aggregate(rows):
+    #sum the counts and keep the earliest first of each (key, move), sorted by (key, move)
+    if len(rows) == 0:
+        return rows
+    rows = rows[np.lexsort((rows["move"], rows["key"]))]
+    starts = np.ones(len(rows), dtype=bool)
+    starts[1:] = (rows["key"][1:] != rows["key"][:-1]) | (rows["move"][1:] != rows["move"][:-1])
+    starts = np.flatnonzero(starts)
+    out = rows[starts]
+    out["cnt"] = np.add.reduceat(rows["cnt"], starts)
+    out["first"] = np.minimum.reduceat(rows["first"], starts)
+    return out
+
+def position_totals(rows):
+    #for rows sorted by key: the start of each key and its total count
+    if len(rows) == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.uint64)
+    starts = np.ones(len(rows), dtype=bool)
+    starts[1:] = rows["key"][1:] != rows["key"][:-1]
+    starts = np.flatnonzero(starts)
+    return starts, np.add.reduceat(rows["cnt"].astype(np.uint64), starts)
+
+class PositionCounter():
+    def __init__(self, spill_dir=None, max_rows=MAX_ROWS, chunk_rows=CHUNK_ROWS):
+        self.max_rows = max_rows
+        self.chunk_rows = chunk_rows
+        self.tmp_dir = tempfile.mkdtemp(dir=spill_dir, prefix="position_counts_")
+        self.buffer = ([], [], []) #keys, moves, firsts
+        self.tables = [] #aggregated chunks not yet combined
+        self.table_rows = 0
+        self.runs = []
+    def add(self, key, move, first):
+        self.buffer[0].append(key)
+        self.buffer[1].append(move)
+        self.buffer[2].append(first)
+        if len(self.buffer[0]) >= self.chunk_rows:
+            self.flush_buffer()
+    def add_rows(self, rows):
+        #rows: COUNT_DTYPE array, eg counts from another PositionCounter
+        rows = aggregate(rows)
+        self.tables.append(rows)
+        self.table_rows += len(rows)
+        if self.table_rows >= self.max_rows:
+            #combine the chunks, spilling them if they don't shrink much
+            table = self.combined_table()
+            if len(table) >= self.max_rows // 2:
+                self.spill(table)
+            else:
+                self.tables = [table]
+                self.table_rows = len(table)
+    def flush_buffer(self):
+        keys, moves, firsts = self.buffer
+        if not keys:
+            return
+        rows = np.zeros(len(keys), dtype=COUNT_DTYPE)
+        rows["key"] = np.array(keys, dtype=np.uint64)
+        rows["move"] = moves
+        rows["cnt"] = 1
+        rows["first"] = np.array(firsts, dtype=np.uint64)
+        self.buffer = ([], [], [])
+        self.add_rows(rows)
+    def combined_table(self):
+        return aggregate(np.concatenate(self.tables)) if self.tables else np.zeros(0, dtype=COUNT_DTYPE)
+    def spill(self, table):
+        filename = os.path.join(self.tmp_dir, f"run{len(self.runs)}.npy")
+        np.save(filename, table)
+        self.runs.append(filename)
+        self.tables = []
+        self.table_rows = 0
+    def merged(self):
+        #yield the aggregated counts one slice of the key space at a time, in key order
+        self.flush_buffer()
+        table = self.combined_table()
+        runs = [np.load(filename, mmap_mode="r") for filename in self.runs]
+        total_rows = len(table) + sum(len(run) for run in runs)
+        #keys are hashes so slices of the key space hold about the same number of rows
+        slice_cnt = max(1, -(-total_rows // self.max_rows))
+        bounds = [(2**64 * i) // slice_cnt for i in range(slice_cnt)]
+        for i, lo in enumerate(bounds):
+            parts = []
+            for rows in runs + [table]:
+                start = np.searchsorted(rows["key"], np.uint64(lo))
+                end = np.searchsorted(rows["key"], np.uint64(bounds[i+1])) if i + 1 < slice_cnt else len(rows)
+                parts.append(np.asarray(rows[start:end]))
+            yield aggregate(np.concatenate(parts))
+    def filtered(self, min_cnt):
+        #yield the rows of positions seen at least min_cnt times, one slice at a time
+        for rows in self.merged():
+            starts, totals = position_totals(rows)
+            keep = np.repeat(totals >= min_cnt, np.diff(np.append(starts, len(rows))))
+            yield rows[keep]
+    def close(self):
+        shutil.rmtree(self.tmp_dir, ignore_errors=True)
+    def __enter__(self):
+        return self
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()